@@ -3,6 +3,8 @@ import asyncio
 import os
 import sys
 from preprocesses.DataIndexer import normalize_dataset, build_embeddings, index_results, index_surveys
+from preprocesses.ResultsServer import serve_results
+from preprocesses.Utils import parse_options
 from loguru import logger
 
 load_dotenv()
@@ -20,25 +22,60 @@ Commands:
         Arguments:
             <survey_file> : Path to the survey file to index.
 
-    normalize_dataset <product_file> <source_key>
-        Description: Normalize the dataset.
+    normalize_dataset <product_file> <source_key> [--jsonl] [--workers N]
+        Description: Normalize the dataset. CSVs are streamed, so they can be larger than memory.
         Arguments:
             <product_file> : Path to the product file to normalize.
             <source_key>   : Source key for normalization (e.g., id, product_id).
+            --jsonl : Write JSON lines (<product_file>.jsonl) instead of a JSON array.
+            --workers N : Split the CSV by byte range across N processes (one is used if any quoted value spans lines).
 
-    build_embeddings <data_file>
+    build_embeddings <data_file> [--incremental] [--ann] [--nlist N] [--nprobe N] [--quantize KIND] [--dims N] [--report]
         Description: Build embeddings from the dataset.
         Arguments:
             <data_file> : Path to the data file to build embeddings from.
+            --incremental : Only embed rows that were inserted or changed since the last build, and drop deleted rows.
+            --ann : Also build an approximate nearest-neighbour (IVF) index, used once the catalogue has ANN_MIN_ROWS items.
+            --nlist N : Number of IVF lists (default ANN_NLIST or 4 * sqrt(rows)).
+            --nprobe N : Lists scanned per query (default ANN_NPROBE or 8). Higher is slower with better recall.
+            --quantize KIND : Also keep a float16, int8 or pq (product quantized) copy in memory to search, re-ranking
+                              the best candidates exactly from the float32 store (EMBEDDING_RERANK).
+            --dims N : Truncate each field to its first N dimensions before quantizing (text-embedding-3 models).
+            --report : Print the memory and recall@10 of every quantization.
 
-    index_results
-        Description: Index results.
-        Arguments: None
+    index_results [--full]
+        Description: Index results. Only result files and results changed since the last run are read.
+        Arguments:
+            --full : Rebuild the index and schema from scratch.
+
+    serve [--host HOST] [--port N]
+        Description: Update the results index, load it into SQLite and serve a local query API.
+        Arguments:
+            --host HOST : Interface to listen on (default RESULTS_SERVER_HOST or 127.0.0.1).
+            --port N : Port to listen on (default RESULTS_SERVER_PORT or 8765).
+        Endpoints:
+            /results?q=&prompt_id=&model=&executable=&sort=ms&order=desc&page=1&per_page=50
+                Filtered, full text searched (q, over prompt, instructions and results), sorted and paginated results.
+            /aggregates/ms?by=model,executable
+                Runs and mean / min / max ms per group.
+            /aggregates/exists?by=prompt_id
+                Share of result items that exist in the dataset per group.
     """
     print(help_text)
 
+OPTIONS = {'incremental': bool, 'ann': bool, 'nlist': int, 'nprobe': int, 'full': bool, 'host': str, 'port': int, 'jsonl': bool, 'workers': int,
+           'quantize': str, 'dims': int, 'report': bool}
+
 if __name__ == '__main__':
-    if len(sys.argv) < 2 or sys.argv[1] not in ['index_surveys', 'normalize_dataset', 'build_embeddings', 'index_results']:
+    try:
+        args, options = parse_options(sys.argv[1:], OPTIONS)
+    except ValueError as e:
+        print_help()
+        logger.critical(str(e))
+        sys.exit(1)
+    sys.argv = [sys.argv[0]] + args
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ['index_surveys', 'normalize_dataset', 'build_embeddings', 'index_results', 'serve']:
         print_help()
         logger.critical(f"Invalid command: {sys.argv[1] if len(sys.argv) > 1 else ''}")
         sys.exit(1)
@@ -59,13 +96,19 @@ if __name__ == '__main__':
         if not os.path.exists(sys.argv[2]):
             logger.critical("No such file: " + sys.argv[2])
             sys.exit(1)
-        asyncio.run(normalize_dataset(sys.argv[2], sys.argv[3]))
+        asyncio.run(normalize_dataset(sys.argv[2], sys.argv[3], options.get('jsonl', False), options.get('workers', 1)))
 
     elif command == 'build_embeddings':
         if len(sys.argv) < 3 or not os.path.exists(sys.argv[2]):
             logger.critical("No such file: " + (sys.argv[2] if len(sys.argv) > 2 else ''))
             sys.exit(1)
-        asyncio.run(build_embeddings(sys.argv[2]))
+        asyncio.run(build_embeddings(sys.argv[2], options.get('incremental', False), options.get('ann', False),
+                                     options.get('nlist'), options.get('nprobe'), options.get('quantize'),
+                                     options.get('dims'), options.get('report', False)))
 
     elif command == 'index_results':
+        asyncio.run(index_results(options.get('full', False)))
+
+    elif command == 'serve':
         asyncio.run(index_results())
+        serve_results(options.get('host'), options.get('port'))
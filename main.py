@@ -1,8 +1,9 @@
 import asyncio
 import sys, os
 from itertools import product
-from preprocesses.Prompter import Prompter
-from preprocesses.Utils import read_csv, build_survey
+from preprocesses.Clients import close_clients
+from preprocesses.Scheduler import Scheduler
+from preprocesses.Utils import read_csv, build_survey, parse_options
 from loguru import logger
 
 logger.add("runnerlogs.log", level="DEBUG")
@@ -10,39 +11,58 @@ logger.add(sys.stdout, level="INFO")
 
 def print_help():
     help_text = """
-Usage: python main.py <prompt_csv> <config_csv> [<survey_csv>]
+Usage: python main.py <prompt_csv> <config_csv> [<survey_csv>] [options]
 
 Arguments:
     <prompt_csv> : Path to the CSV file containing prompts.
     <config_csv> : Path to the CSV file containing configuration settings.
     [<survey_csv>] : (Optional) Path to the CSV file containing survey data.
 
+Options:
+    --concurrency N : Number of tests to run at once (default MAX_CONCURRENCY or 4).
+                      THREAD_CONCURRENCY, COMPLETION_CONCURRENCY and EMBEDDINGS_CONCURRENCY cap each executable.
+                      A batch of Embeddings tests (EMBEDDINGS_BATCH_SIZE) counts as one.
+    --resume, --skip-existing : Skip tests that already have a (non-failed) result.
+    --repeat K : Collect K answers per test for variance sampling, running only the missing ones.
+
 Description:
     This script processes prompts and configuration settings from CSV files.
     If a survey CSV file is provided, it will also process survey data.
     """
     print(help_text)
 
+OPTIONS = {'concurrency': int, 'resume': bool, 'skip_existing': bool, 'repeat': int}
+
 async def main():
-    if len(sys.argv) < 3:
+    try:
+        args, options = parse_options(sys.argv[1:], OPTIONS)
+    except ValueError as e:
+        print_help()
+        logger.critical(str(e))
+        sys.exit(1)
+
+    if len(args) < 2:
         print_help()
         logger.critical("Insufficient arguments provided.")
         sys.exit(1)
 
-    prompt_csv = read_csv(sys.argv[1])
-    config_csv = read_csv(sys.argv[2])
+    prompt_csv = read_csv(args[0])
+    config_csv = read_csv(args[1])
 
-    if len(sys.argv) > 3:
-        if not os.path.exists(sys.argv[3]):
-            logger.critical("No such file: " + sys.argv[3])
+    if len(args) > 2:
+        if not os.path.exists(args[2]):
+            logger.critical("No such file: " + args[2])
             sys.exit(1)
-        survey_json = build_survey(sys.argv[3])
+        survey_json = build_survey(args[2])
     else:
         survey_json = [False]
 
-    for prompt, config, survey in product(prompt_csv, config_csv, survey_json):
-        recommender = Prompter(prompt, config, survey) # WARN: arguments can be mutated inside.
-        await recommender.complete()
+    scheduler = Scheduler(options.get('concurrency'), skip_existing=options.get('resume') or options.get('skip_existing'),
+                          repeat=options.get('repeat'))
+    try:
+        await scheduler.run(product(prompt_csv, config_csv, survey_json))
+    finally:
+        await close_clients()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CHUNK_ROWS = 65536  # rows scored at once while assigning lists, to bound memory
+
+
+def index_path(store_file):
+    return store_file + '.ivf.npz'
+
+
+def assign_lists(matrix, centroids):
+    assignments = np.empty(matrix.shape[0], dtype=np.int32)
+    for start in range(0, matrix.shape[0], CHUNK_ROWS):
+        chunk = np.asarray(matrix[start:start + CHUNK_ROWS], dtype=np.float32)
+        assignments[start:start + CHUNK_ROWS] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def kmeans(data, k, iterations, rng):
+    """
+    Spherical k-means: store rows are made of normalized blocks, so centroids are compared by inner product.
+    """
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign_lists(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+        counts = np.bincount(assignments, minlength=k)
+        empty = counts == 0
+        sums[empty] = data[rng.choice(len(data), int(empty.sum()))]  # reseed empty lists
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+class IVFIndex:
+    """
+    An inverted-file (IVF-flat) index over an EmbeddingStore matrix, in plain NumPy.
+
+    Rows are clustered into `nlist` lists at build time; a query scores the centroids, then only the rows
+    of its `nprobe` closest lists. Raising `nprobe` trades speed for recall. Rows appended to the store
+    after the index was built are always scanned exactly, so incremental builds don't lose items.
+    """
+
+    def __init__(self, centroids, offsets, order, rows, nprobe=None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.order = order
+        self.rows = int(rows)
+        self.nprobe = int(nprobe or os.getenv("ANN_NPROBE", 0) or 8)  # an explicit or saved nprobe wins over the env
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, matrix, nlist=None, nprobe=None, iterations=10, seed=0):
+        rows = matrix.shape[0]
+        nlist = int(nlist or os.getenv("ANN_NLIST", 0) or max(1, 4 * int(np.sqrt(rows))))
+        nlist = min(nlist, rows)
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(rows, min(rows, nlist * 64), replace=False)
+        centroids = kmeans(np.asarray(matrix[np.sort(sample)], dtype=np.float32), nlist, iterations, rng)
+
+        assignments = assign_lists(matrix, centroids)
+        order = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=nlist))]).astype(np.int64)
+        return cls(centroids, offsets, order, rows, nprobe)
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, offsets=self.offsets, order=self.order, rows=self.rows,
+                 nprobe=self.nprobe)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["centroids"], data["offsets"], data["order"], data["rows"], data["nprobe"])
+
+    def candidates(self, query, total_rows, nprobe=None):
+        nprobe = min(int(nprobe or self.nprobe), self.nlist)
+        probes = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        lists = [self.order[self.offsets[c]:self.offsets[c + 1]] for c in probes]
+        if total_rows > self.rows:
+            lists.append(np.arange(self.rows, total_rows))
+        return np.concatenate(lists)
+
+    def search(self, matrix, queries, top_n, deleted=None, nprobe=None):
+        """
+        Returns the top `top_n` row indices for each (already tiled) query row, best first.
+        """
+        from .EmbeddingStore import top_k
+
+        results = []
+        for query in queries:
+            candidates = np.sort(self.candidates(query, matrix.shape[0], nprobe))  # sorted reads are kinder to the memmap
+            if deleted:
+                candidates = candidates[~np.isin(candidates, list(deleted))]
+            scores = np.asarray(matrix[candidates], dtype=np.float32) @ query
+            results.append(candidates[top_k(scores, top_n)])
+        return results
+
+
+def recall_at_k(store, index, k=10, queries=100, nprobe=None, seed=0):
+    """
+    Measures how many of the exact top-k results the index finds, using catalogue rows as queries.
+    """
+    alive = [i for i in range(store.matrix.shape[0]) if i not in store.deleted]
+    if len(alive) == 0:
+        return 1.0
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(alive, min(queries, len(alive)), replace=False)
+    # fold each row's field blocks back into one query embedding
+    vectors = np.asarray(store.matrix[np.sort(picks)], dtype=np.float32).reshape(len(picks), len(store.fields), store.dim).sum(axis=1)
+
+    exact = store.search(vectors, k, exact=True)
+    approximate = index.search(store.matrix, store.query_matrix(vectors), k, store.deleted, nprobe)
+    found = sum(len(set(e.tolist()) & set(a.tolist())) for e, a in zip(exact, approximate))
+    return found / max(1, sum(len(e) for e in exact))
@@ -0,0 +1,116 @@
+import os
+import threading
+
+import httpx
+from dotenv import load_dotenv
+from loguru import logger
+from openai import AsyncOpenAI
+from openai import OpenAI
+
+load_dotenv()
+
+
+class ConnectionStats:
+    """
+    Counts requests against new TCP connections and TLS handshakes using httpcore's trace hooks,
+    so a run can tell whether the pool is actually being reused.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.handshakes = 0
+
+    def record(self, name):
+        with self.lock:
+            if name == 'connection.connect_tcp.complete':
+                self.connections += 1
+            elif name == 'connection.start_tls.complete':
+                self.handshakes += 1
+
+    def trace(self, name, info):
+        self.record(name)
+
+    async def trace_async(self, name, info):
+        self.record(name)
+
+    def on_request(self, request):
+        with self.lock:
+            self.requests += 1
+        request.extensions["trace"] = self.trace
+
+    async def on_request_async(self, request):
+        with self.lock:
+            self.requests += 1
+        request.extensions["trace"] = self.trace_async
+
+    def summary(self):
+        with self.lock:
+            reused = max(0, self.requests - self.connections)
+            return {
+                "requests": self.requests,
+                "connections": self.connections,
+                "tls_handshakes": self.handshakes,
+                "reused": reused,
+                "reuse_rate": round(reused / self.requests, 3) if self.requests else 0,
+            }
+
+
+stats = ConnectionStats()
+_clients = {}
+_lock = threading.Lock()
+
+
+def use_http2():
+    if os.getenv("HTTP2", "true").lower() not in ['true', 'yes', '1']:
+        return False
+    try:
+        import h2  # noqa: F401 - httpx only needs it installed
+        return True
+    except ImportError:
+        logger.warning("HTTP/2 requested but the `h2` package is not installed, falling back to HTTP/1.1")
+        return False
+
+
+def pool_limits():
+    return httpx.Limits(
+        max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", 100)),
+        max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", 20)),
+        keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30)),
+    )
+
+
+def get_openai():
+    """
+    The process-wide blocking client, shared by Embeddings and any worker threads.
+    """
+    with _lock:
+        if 'sync' not in _clients:
+            http_client = httpx.Client(limits=pool_limits(), http2=use_http2(),
+                                       event_hooks={"request": [stats.on_request]})
+            # retries are handled by the rate limiter
+            _clients['sync'] = OpenAI(api_key=os.getenv("OPENAI_KEY"), http_client=http_client, max_retries=0)
+        return _clients['sync']
+
+
+def get_async_openai():
+    """
+    The process-wide async client, shared by every Prompter in the run.
+    """
+    with _lock:
+        if 'async' not in _clients:
+            http_client = httpx.AsyncClient(limits=pool_limits(), http2=use_http2(),
+                                            event_hooks={"request": [stats.on_request_async]})
+            _clients['async'] = AsyncOpenAI(api_key=os.getenv("OPENAI_KEY"), http_client=http_client, max_retries=0)
+        return _clients['async']
+
+
+async def close_clients():
+    with _lock:
+        clients = dict(_clients)
+        _clients.clear()
+    if 'async' in clients:
+        await clients['async'].close()
+    if 'sync' in clients:
+        clients['sync'].close()
@@ -1,4 +1,3 @@
-import csv
 import json
 import os
 import shutil
@@ -6,13 +5,43 @@ import sys
 
 import aiofiles
 from dotenv import load_dotenv
+from preprocesses.AnnIndex import IVFIndex, index_path, recall_at_k
+from preprocesses.EmbeddingCache import get_embedding_cache
+from preprocesses.EmbeddingStore import store_path
+from preprocesses.Normalizer import normalize_csv
+from preprocesses.Quantization import quantization_report
 from preprocesses.Embeddings import Embeddings
-from preprocesses.Utils import convert_to_number, sanitize_header, cast_to_boolean, make_label, check_type, parse_date, reconstruct_object, build_survey, stringify_survey, adler32
+from preprocesses.ResultsIndex import ResultsIndex
+from preprocesses.ResultsStore import get_results_store, results_dir
+from preprocesses.Utils import make_label, check_type, parse_date, reconstruct_object, build_survey, stringify_survey, adler32
 
 load_dotenv()
 
-async def build_embeddings(file_path):
-    Embeddings(file_path)
+async def build_embeddings(file_path, incremental=False, ann=False, nlist=None, nprobe=None, quantize=None, dims=None,
+                           report=False):
+    # saving or compacting the store drops its IVF index, so an index that existed is rebuilt with its settings
+    previous = IVFIndex.load(index_path(store_path(file_path))) if os.path.exists(index_path(store_path(file_path))) else None
+    embeddings = Embeddings(file_path, incremental=incremental)
+    print('Embedding cache:', get_embedding_cache().stats())
+
+    store = embeddings.get_store()
+    if len(store) == 0:
+        return
+    if ann or (previous is not None and (store.index is None or store.index.rows < len(store.ids))):
+        index = store.build_index(embeddings.embeddings_path(), nlist or (previous.nlist if previous is not None else None),
+                                  nprobe or (previous.nprobe if previous is not None else None))
+        print(f'Built IVF index: {index.nlist} lists, nprobe {index.nprobe}')
+        print(f'recall@10: {recall_at_k(store, index, 10):.3f}')
+    if quantize or dims:
+        if dims and not str(store.model or '').startswith('text-embedding-3'):
+            print(f'{store.model} embeddings may not keep their quality when truncated to {dims} dimensions')
+        quantized = store.quantize(embeddings.embeddings_path(), quantize or 'float16', dims)
+        print(f'Quantized to {quantized.kind}, {quantized.dims} dims per field: '
+              f'{quantized.nbytes / 1024 / 1024:.1f} MB (float32 {store.matrix.nbytes / 1024 / 1024:.1f} MB)')
+    if report:
+        print(f'{"kind":>8} {"dims":>6} {"MB":>9} {"recall@10":>10} {"reranked":>9}')
+        for line in quantization_report(store, 10, dims_options=[dims] if dims else [256, 512]):
+            print(f'{line["kind"]:>8} {line["dims"]:>6} {line["mb"]:>9} {line["recall"]:>10} {line["recall_reranked"]:>9}')
 
 
 
@@ -43,52 +72,71 @@ def add_column(val, key):
 
     return column
 
-async def index_results():
-    output_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', os.getenv("RESULTS_DIR")))
-    files = os.listdir(output_dir)
-    json_files = [file for file in files if file.endswith('.json')]
+def result_row(columns, filename, runkey, run):
+    top_level_properties = {'filename': filename, 'runkey': runkey}
+    for key, value in run.items():
+        top_level_properties[key] = value
+        if key not in columns:
+            columns[key] = add_column(value, key)
 
-    results = []
-    columns = {}
+    unsets = ['assistant', 'file_search', 'vector_store', 'code_interpreter']
+    for u in unsets:
+        if u in top_level_properties['config']:
+            del top_level_properties['config'][u]
 
-    for filename in json_files:
-        file_path = os.path.join(output_dir, filename)
-        async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
-            data = await f.read()
-            json_data = json.loads(data)
-            for run in json_data:
-                top_level_properties = {'filename': filename, 'runkey': run}
-                for key, value in json_data[run].items():
-                    top_level_properties[key] = value
-                    if key not in columns:
-                        columns[key] = add_column(value, key)
+    if 'file_id' in top_level_properties['config'] and top_level_properties['config']['file_id'] == top_level_properties['config']['file_path']:
+        del top_level_properties['config']['file_path']
 
-                unsets = ['assistant', 'file_search', 'vector_store', 'code_interpreter']
-                for u in unsets:
-                    if u in top_level_properties['config']:
-                        del top_level_properties['config'][u]
+    return top_level_properties
 
-                if 'file_id' in top_level_properties['config'] and top_level_properties['config']['file_id'] == top_level_properties['config']['file_path']:
-                    del top_level_properties['config']['file_path']
 
-                results.append(top_level_properties)
+async def index_results(full=False):
+    output_dir = results_dir()
+    index = ResultsIndex(output_dir)
+    if full:
+        index.reset()
+    columns = index.state["columns"]
+    schema_size = len(columns)
 
-    # columns.sort(key=lambda x: x.get('started'))
-    columns = reconstruct_object(columns, ['ms', 'started', 'ended', 'prompt', 'instructions', 'survey_id', 'response', 'config', 'results'])
+    # result files written before the results store; the store's rows are appended after, so they win
+    files = os.listdir(output_dir) if os.path.isdir(output_dir) else []
+    json_files = [file for file in files if file.endswith('.json')]
+    changed = index.changed_files(output_dir, json_files)
 
-    field_schema = json.dumps(columns, indent=2)  # Pretty-print with 2-space indentation
-    new_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src/schema.json'))
-    async with aiofiles.open(new_path, 'w', encoding='utf-8') as f:
-        await f.write(field_schema)
+    for filename, signature in changed:
+        file_path = os.path.join(output_dir, filename)
+        async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
+            data = await f.read()
+            json_data = json.loads(data)
+            index.index_file(filename, signature, [(run, result_row(columns, filename, run, json_data[run])) for run in json_data])
+
+    rows = []
+    for seq, test_id, runkey, run in get_results_store().rows(index.state["store_seq"]):
+        filename = f'result-{test_id}.json'
+        row = result_row(columns, filename, runkey, run)
+        rows.append(([filename, runkey], row.get('prompt_id'), row))
+        index.state["store_seq"] = seq
+        if len(rows) >= 1000:
+            index.append(rows)
+            rows = []
+    index.append(rows)
 
-    json_string = json.dumps(results, indent=2)  # Pretty-print with 2-space indentation
     new_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../public', os.getenv("REACT_APP_RESULTS_INDEX")))
-    async with aiofiles.open(new_path, 'w', encoding='utf-8') as f:
-        await f.write(json_string)
-
-
-    print('Results Index:', results)
-    print('New Schema:', field_schema)
+    # the viewer loads `<index name>/manifest.json` and then only the prompt_id shards it shows
+    total = index.write(new_path, os.path.splitext(new_path)[0])
+
+    schema_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src/schema.json'))
+    if len(columns) != schema_size or full or not os.path.exists(schema_path):
+        # columns.sort(key=lambda x: x.get('started'))
+        columns = reconstruct_object(columns, ['ms', 'started', 'ended', 'prompt', 'instructions', 'survey_id', 'response', 'config', 'results'])
+        index.state["columns"] = columns
+        field_schema = json.dumps(columns, indent=2)  # Pretty-print with 2-space indentation
+        async with aiofiles.open(schema_path, 'w', encoding='utf-8') as f:
+            await f.write(field_schema)
+        print('New Schema:', ', '.join(columns.keys()))
+
+    index.save()
+    print(f'Results Index: {index.added} rows added from {len(changed)} changed files and the results store, {total} rows in {new_path}')
 
 async def index_surveys(survey_file):
     output_file = os.getenv("SURVEYS_INDEX")
@@ -120,31 +168,16 @@ async def index_surveys(survey_file):
 
 
 
-async def normalize_dataset(file_path, source_key):
+async def normalize_dataset(file_path, source_key, jsonl=False, workers=1):
 
     if ".csv" in file_path:  # csv can be retrieved: https://platform.openai.com/docs/assistants/tools/file-search/supported-files
         base, _ = os.path.splitext(file_path)
-        json_data = []
+        csv_path = file_path
+        file_path = base + ('.jsonl' if jsonl else '.json')
 
         try:
-            with open(file_path, mode='r', newline='', encoding='utf-8') as csv_file:
-                csv_reader = csv.DictReader(csv_file)
-                data = []
-                file_path = base + '.json'
-
-                for row in csv_reader:
-                    new_row = {}
-                    for key, value in row.items():
-                        new_key = sanitize_header(key)
-                        new_key = new_key.replace(source_key, "source_id")
-
-                        new_row[new_key] = cast_to_boolean(value)
-                        new_row[new_key] = convert_to_number(value)
-
-                    data.append(new_row)
-
-                with open(file_path, mode='w', encoding='utf-8') as json_file:
-                    json.dump(data, json_file)
+            count = normalize_csv(csv_path, source_key, file_path, jsonl, workers)
+            print(f'normalized {count} rows into {file_path}')
 
         except Exception as e:
             print(f"Error reading {file_path}: {e}")
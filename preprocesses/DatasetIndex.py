@@ -0,0 +1,108 @@
+import asyncio
+import re
+from difflib import SequenceMatcher
+
+from .Utils import find_id_property
+
+FUZZY_CUTOFF = 0.8
+MAX_FUZZY_CANDIDATES = 200
+
+
+def normalize_id(value):
+    # models often quote numeric ids ("100606" for 100606)
+    return str(value).strip().casefold()
+
+
+def normalize_title(value):
+    return re.sub(r'[^0-9a-z]+', ' ', str(value).casefold()).strip()
+
+
+def find_title_property(record, id_key=None):
+    for key in ['title', 'name']:
+        if key in record:
+            return key
+    for key, value in record.items():
+        if key != id_key and isinstance(value, str):
+            return key
+    return None
+
+
+class DatasetIndex:
+    """
+    Hash indexes over a dataset's records so validating a response item is O(1) instead of a scan
+    of the whole catalogue. Ids are matched first, then exact (normalized) titles, then fuzzy titles
+    drawn from a token index so only records sharing a word with the response are compared.
+    """
+
+    def __init__(self, records):
+        self.records = [record for record in records if isinstance(record, dict)]
+        first = self.records[0] if len(self.records) > 0 else {}
+        self.id_key = find_id_property(first)
+        self.title_key = find_title_property(first, self.id_key)
+        self.ids = {}
+        self.titles = {}
+        self.tokens = {}
+
+        for record in self.records:
+            if self.title_key and record.get(self.title_key) is not None:
+                title = normalize_title(record[self.title_key])
+                self.titles.setdefault(title, record)
+                for token in set(title.split()):
+                    self.tokens.setdefault(token, []).append(title)
+
+    def by_id(self, key):
+        # one dict per id property, since responses don't always use the dataset's own id name
+        if key not in self.ids:
+            self.ids[key] = {normalize_id(record[key]): record for record in self.records if record.get(key) is not None}
+        return self.ids[key]
+
+    def find(self, item, key):
+        """
+        Returns (record, matched_by) for a response item, where matched_by is 'id', 'title', 'fuzzy' or None.
+        """
+        if key and item.get(key) is not None:
+            record = self.by_id(key).get(normalize_id(item[key]))
+            if record is not None:
+                return record, 'id'
+
+        title = item.get(self.title_key) if self.title_key else None
+        if title is None:
+            title = item.get('title', item.get('name'))
+        if title is None:
+            return None, None
+
+        title = normalize_title(title)
+        if title in self.titles:
+            return self.titles[title], 'title'
+
+        # rarest shared words first, so common words don't flood the candidates
+        candidates = []
+        for token in sorted(set(title.split()), key=lambda t: len(self.tokens.get(t, []))):
+            candidates.extend(self.tokens.get(token, []))
+            if len(candidates) >= MAX_FUZZY_CANDIDATES:
+                break
+        best, best_ratio = None, FUZZY_CUTOFF
+        for candidate in dict.fromkeys(candidates[:MAX_FUZZY_CANDIDATES]):
+            ratio = SequenceMatcher(None, title, candidate).ratio()
+            if ratio >= best_ratio:
+                best, best_ratio = candidate, ratio
+        if best is not None:
+            return self.titles[best], 'fuzzy'
+        return None, None
+
+
+_indexes = {}
+_locks = {}
+
+
+async def load_dataset_index(name, loader):
+    """
+    Returns the shared index for a dataset, loading it through `loader` the first time any cell asks.
+    """
+    if name not in _locks:
+        _locks[name] = asyncio.Lock()
+    async with _locks[name]:
+        if name not in _indexes:
+            records = await loader()
+            _indexes[name] = DatasetIndex(records) if isinstance(records, list) else None
+        return _indexes[name]
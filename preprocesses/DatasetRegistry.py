@@ -0,0 +1,144 @@
+import json
+import os
+import threading
+
+import pandas
+
+from .EmbeddingStore import store_path, store_records
+from .Embeddings import Embeddings
+from .Utils import get_encoding, parse_jsonl
+
+SKIP_DIRS = ['dist', 'node_modules', 'vendor', 'build', "__pycache__"]
+DATA_PROMPT = "Make your recommendation based on this data: \n\n {}"
+CHUNK_PROMPT = "Make your recommendation based on this part of the data: \n\n {}"
+
+
+class DatasetRegistry:
+    """
+    Loads each dataset once per run. Entries are keyed by absolute path and invalidated when the file's
+    mtime or size changes, and hold the raw text (what Completion prompts embed), the parsed records
+    (what validation reads), the finished prompt block and, for embedding stores, the loaded catalogue.
+
+    Filenames of assistant-uploaded files are resolved to local paths from one walk of the project
+    tree, instead of walking it again for every result.
+    """
+
+    def __init__(self, base_dir=None):
+        self.base_dir = base_dir or os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        self.entries = {}
+        self.files = None
+        self.lock = threading.RLock()
+
+    def scan(self):
+        files = {}
+        for root, dirnames, filenames in os.walk(self.base_dir):
+            # Filter out hidden directories and directories in the skips list
+            dirnames[:] = [d for d in dirnames if not d.startswith('.') and d not in SKIP_DIRS]
+            for name in filenames:
+                files.setdefault(name, os.path.join(os.path.abspath(root), name))
+        with self.lock:
+            self.files = files
+        return files
+
+    def resolve(self, filename):
+        if self.files is None:
+            self.scan()
+        return self.files.get(os.path.basename(filename))
+
+    def signature(self, file_path):
+        stat = os.stat(file_path)
+        return os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size
+
+    def entry(self, file_path):
+        signature = self.signature(file_path)
+        with self.lock:
+            entry = self.entries.get(signature[0])
+            if entry is None or entry["signature"] != signature:
+                entry = {"signature": signature}
+                self.entries[signature[0]] = entry
+            return entry
+
+    def cached(self, file_path, key, load):
+        """
+        Returns one value of a dataset's entry, loading it the first time. The registry lock only guards the
+        entries; each value loads under its own lock, so a slow load (a large catalogue, a .pkl conversion)
+        only makes callers of that same value wait, never the event loop reading something else.
+        """
+        entry = self.entry(file_path)
+        with self.lock:
+            if key in entry:
+                return entry[key]
+            lock = entry.setdefault("locks", {}).setdefault(key, threading.Lock())
+        with lock:
+            if key not in entry:
+                entry[key] = load()
+            return entry[key]
+
+    def text(self, file_path):
+        def load():
+            with open(file_path, 'r') as f:
+                return f.read()
+        return self.cached(file_path, "text", load)
+
+    def prompt(self, file_path):
+        return self.cached(file_path, "prompt", lambda: DATA_PROMPT.format(self.text(file_path)))
+
+    def embeddings(self, file_path, client=None):
+        """
+        The loaded catalogue behind an `.emb` (or legacy `.pkl`) path, shared by every Embeddings cell.
+        """
+        return self.cached(file_path, "embeddings", lambda: Embeddings(file_path, client))
+
+    def chunks(self, file_path, model_name, budget):
+        """
+        Splits a JSON list dataset into prompt blocks of at most `budget` tokens, cached per model and budget.
+        Returns None for datasets that aren't a list of records.
+        """
+        return self.cached(file_path, ("chunks", model_name, budget), lambda: self.split(file_path, model_name, budget))
+
+    def split(self, file_path, model_name, budget):
+        records = self.records(file_path)
+        if not isinstance(records, list) or len(records) == 0:
+            return None
+        encoding = get_encoding(model_name)
+        overhead = len(encoding.encode(CHUNK_PROMPT.format('[]')))
+        chunks, current, used = [], [], overhead
+        for record in records:
+            text = json.dumps(record)
+            tokens = len(encoding.encode(text)) + 1  # the separating comma
+            # an oversized record still gets a chunk of its own
+            if len(current) > 0 and used + tokens > budget:
+                chunks.append(current)
+                current, used = [], overhead
+            current.append(text)
+            used += tokens
+        chunks.append(current)
+        return [CHUNK_PROMPT.format('[' + ',\n'.join(chunk) + ']') for chunk in chunks]
+
+    def records(self, file_path):
+        return self.cached(file_path, "records", lambda: self.parse(file_path))
+
+    def parse(self, file_path):
+        if ".csv" in file_path:
+            df = pandas.read_csv(file_path, nrows=0)  # Read only the header row
+            return df.columns.tolist()
+        elif file_path.endswith(".jsonl"):
+            return parse_jsonl(self.text(file_path))
+        elif ".json" in file_path:
+            return json.loads(self.text(file_path))
+        elif ".emb" in file_path or ".pkl" in file_path:
+            if os.path.exists(store_path(file_path)):
+                return store_records(file_path)  # ids and titles only, without touching the vectors
+            df = pandas.read_pickle(file_path)
+            return df.to_dict(orient='records')
+        return None
+
+
+_registry = None
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = DatasetRegistry()
+    return _registry
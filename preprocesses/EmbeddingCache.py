@@ -0,0 +1,137 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def normalize_text(text):
+    return ' '.join(str(text).split())
+
+
+def text_hash(text):
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    A persistent SQLite cache of embeddings keyed by (model, normalized text hash), shared by every
+    dataset and run. Vectors are stored as float32 blobs and the least recently used rows are evicted
+    once the cache grows past EMBEDDING_CACHE_MAX_MB.
+    """
+
+    def __init__(self, path=None, max_mb=None):
+        self.path = path or os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                                         os.getenv("EMBEDDING_CACHE", ".cache/embeddings.sqlite")))
+        self.max_bytes = int(float(max_mb or os.getenv("EMBEDDING_CACHE_MAX_MB", 1024)) * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+            model TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            bytes INTEGER NOT NULL,
+            used REAL NOT NULL,
+            PRIMARY KEY (model, hash))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model, texts):
+        """
+        Returns {text: embedding} for every cached text and bumps their last-used time.
+        """
+        hashes = {}
+        for text in texts:
+            hashes.setdefault(text_hash(text), []).append(text)
+
+        found = {}
+        keys = list(hashes.keys())
+        with self.lock:
+            for i in range(0, len(keys), 500):  # stay under SQLite's bound variable limit
+                chunk = keys[i:i + 500]
+                rows = self.db.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(chunk))})",
+                    [model] + chunk).fetchall()
+                for key, vector in rows:
+                    embedding = np.frombuffer(vector, dtype=np.float32).tolist()
+                    for text in hashes[key]:
+                        found[text] = embedding
+                self.db.executemany("UPDATE embeddings SET used = ? WHERE model = ? AND hash = ?",
+                                    [(time.time(), model, key) for key, _ in rows])
+            self.db.commit()
+            self.hits += len(found)
+            self.misses += len(texts) - len(found)
+        return found
+
+    def get(self, model, text):
+        return self.get_many(model, [text]).get(text)
+
+    def put_many(self, model, embeddings):
+        rows = []
+        for text, embedding in embeddings.items():
+            if embedding is None:
+                continue
+            vector = np.asarray(embedding, dtype=np.float32).tobytes()
+            rows.append((model, text_hash(text), vector, len(vector), time.time()))
+        if len(rows) == 0:
+            return
+
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO embeddings (model, hash, vector, bytes, used) VALUES (?, ?, ?, ?, ?)",
+                                rows)
+            self.db.commit()
+            self.size += sum(row[3] for row in rows)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # callers hold the lock; trim to 90% so we don't evict again on the very next write
+        self.size = self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM embeddings").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        while self.size > target:
+            rows = self.db.execute("SELECT rowid, bytes FROM embeddings ORDER BY used LIMIT 1000").fetchall()
+            if len(rows) == 0:
+                break
+            removed = []
+            for rowid, size in rows:
+                if self.size <= target:
+                    break
+                removed.append((rowid,))
+                self.size -= size
+            self.db.executemany("DELETE FROM embeddings WHERE rowid = ?", removed)
+            self.evicted += len(removed)
+        self.db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0,
+            "evicted": self.evicted,
+            "mb": round(self.size / 1024 / 1024, 1),
+        }
+
+
+_embedding_cache = None
+_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    global _embedding_cache
+    with _lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache()
+        return _embedding_cache
@@ -0,0 +1,302 @@
+import json
+import os
+import re
+
+import numpy as np
+from dotenv import load_dotenv
+
+from .AnnIndex import IVFIndex, index_path
+from .Quantization import Quantized, quant_path
+
+load_dotenv()
+
+FORMAT = "promptautomator-embeddings"
+FORMAT_VERSION = 1
+COMPACT_RATIO = 0.25  # rewrite the matrix once this share of its rows are deleted
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def is_vector(value):
+    return isinstance(value, (list, np.ndarray)) and len(value) > 0
+
+
+def store_path(file_path):
+    """
+    The `.emb` header for a dataset, embedding or legacy `.pkl` path.
+    """
+    base, ext = os.path.splitext(file_path)
+    return file_path if ext == '.emb' else base + '.emb'
+
+
+def read_header(path):
+    with open(path, 'r') as f:
+        header = json.load(f)
+    if header.get("format") != FORMAT:
+        raise ValueError(f"Not an embedding store: {path}")
+    if header.get("version", 0) > FORMAT_VERSION:
+        raise ValueError(f"{path} was written by a newer version (format {header['version']})")
+    return header
+
+
+def store_records(file_path):
+    """
+    The live {source_key, title_key} records of a store, read from the header alone.
+    """
+    header = read_header(store_path(file_path))
+    deleted = set(header.get("deleted", []))
+    return [{header["source_key"]: source_id, header["title_key"]: title}
+            for i, (source_id, title) in enumerate(zip(header["ids"], header["titles"])) if i not in deleted]
+
+
+class EmbeddingStore:
+    """
+    One contiguous float32 matrix of catalogue embeddings.
+
+    Each `*_embedding` column becomes a block of `dim` columns and every block is L2-normalized, so a
+    query repeated across the blocks (scaled by per-field weights) scores the weighted mean cosine
+    similarity over fields with a single matrix-vector product, or one matrix-matrix product for a batch.
+
+    On disk a store is a `.emb` JSON header (format version, model, fields, ids, titles, row hashes and
+    deleted rows) next to a raw `.emb.vectors` matrix that is opened with np.memmap, so loading is
+    near-instant and the pages are shared by every process reading the same catalogue.
+    """
+
+    def __init__(self, matrix, ids, titles, fields, model=None, source_key='source_id', title_key='title',
+                 hashes=None, deleted=None):
+        self.matrix = matrix if isinstance(matrix, np.memmap) else np.ascontiguousarray(matrix, dtype=np.float32)
+        self.ids = ids
+        self.titles = titles
+        self.fields = fields
+        self.model = model
+        self.source_key = source_key
+        self.title_key = title_key
+        self.hashes = hashes if hashes is not None else [None] * len(ids)
+        self.deleted = set(deleted or [])
+        self.dim = self.matrix.shape[1] // max(1, len(fields))
+        self.index = None
+        self.quantized = None
+        self.ann_min_rows = int(os.getenv("ANN_MIN_ROWS", 50000))
+        self.rerank = int(os.getenv("EMBEDDING_RERANK", 4))
+
+    def __len__(self):
+        return self.matrix.shape[0] - len(self.deleted)
+
+    @classmethod
+    def from_dataframe(cls, df, source_key, title_key, model=None):
+        fields = [column for column in df.columns if column.endswith('_embedding')]
+        # like the old dropna(): rows missing any field's embedding can't be scored
+        valid = np.ones(len(df), dtype=bool)
+        for field in fields:
+            valid &= np.array([is_vector(value) for value in df[field].values], dtype=bool)
+        rows = df[valid]
+
+        if len(fields) > 0 and len(rows) > 0:
+            matrix = np.hstack([normalize_rows(np.array(rows[field].tolist(), dtype=np.float32)) for field in fields])
+        else:
+            matrix = np.zeros((len(rows), 0), dtype=np.float32)
+        hashes = rows['row_hash'].tolist() if 'row_hash' in rows.columns else None
+        return cls(matrix, rows[source_key].tolist(), rows[title_key].tolist(), fields, model, source_key, title_key,
+                   hashes)
+
+    @classmethod
+    def load(cls, path, mode='r'):
+        header = read_header(path)
+        width = header["dim"] * len(header["fields"])
+        if header["rows"] > 0:
+            matrix = np.memmap(path + '.vectors', dtype=header["dtype"], mode=mode, shape=(header["rows"], width))
+        else:
+            matrix = np.zeros((0, width), dtype=header["dtype"])
+        store = cls(matrix, header["ids"], header["titles"], header["fields"], header.get("model"),
+                    header["source_key"], header["title_key"], header.get("hashes"), header.get("deleted"))
+        if os.path.exists(index_path(path)):
+            store.index = IVFIndex.load(index_path(path))
+        if os.path.exists(quant_path(path)):
+            quantized = Quantized.load(quant_path(path))
+            if quantized.rows == matrix.shape[0] and quantized.fields == len(store.fields):
+                store.quantized = quantized
+            else:
+                print(f'Ignoring stale {quant_path(path)}, rebuild it with build_embeddings --quantize')
+        return store
+
+    def header(self):
+        return {
+            "format": FORMAT,
+            "version": FORMAT_VERSION,
+            "model": self.model,
+            "dtype": str(self.matrix.dtype),
+            "dim": self.dim,
+            "fields": self.fields,
+            "rows": len(self.ids),
+            "source_key": self.source_key,
+            "title_key": self.title_key,
+            "ids": self.ids,
+            "titles": self.titles,
+            "hashes": self.hashes,
+            "deleted": sorted(self.deleted),
+        }
+
+    def write_header(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.header(), f, default=str)
+        os.replace(tmp_path, path)
+
+    def save(self, path):
+        tmp_path = f"{path}.vectors.{os.getpid()}.tmp"
+        np.ascontiguousarray(self.matrix).tofile(tmp_path)
+        os.replace(tmp_path, path + '.vectors')
+        self.write_header(path)
+        for derived in [index_path(path), quant_path(path)]:
+            if os.path.exists(derived):  # row numbers changed, the old index and codes no longer apply
+                os.remove(derived)
+        return self
+
+    def build_index(self, path, nlist=None, nprobe=None):
+        self.index = IVFIndex.build(self.matrix, nlist, nprobe)
+        self.index.save(index_path(path))
+        return self.index
+
+    def quantize(self, path, kind='int8', dims=None):
+        """
+        Builds the compressed copy of the matrix that search scores, see Quantized, and saves it next to the store.
+        """
+        self.quantized = Quantized.build(self, kind, dims)
+        self.quantized.save(quant_path(path))
+        return self.quantized
+
+    def compact(self, path):
+        alive = [i for i in range(self.matrix.shape[0]) if i not in self.deleted]
+        compacted = EmbeddingStore(np.array(self.matrix[alive]), [self.ids[i] for i in alive],
+                                   [self.titles[i] for i in alive], self.fields, self.model, self.source_key,
+                                   self.title_key, [self.hashes[i] for i in alive])
+        compacted.save(path)
+        return EmbeddingStore.load(path)
+
+    def apply_changes(self, path, changed, removed_ids):
+        """
+        Updates the store at `path` in place: rows in `changed` overwrite their existing row or are appended,
+        and `removed_ids` are marked deleted. Returns the reloaded store.
+        """
+        positions = {source_id: i for i, source_id in enumerate(self.ids) if i not in self.deleted}
+        for source_id in removed_ids:
+            if source_id in positions:
+                self.deleted.add(positions.pop(source_id))
+
+        overwrites = [(positions[source_id], j) for j, source_id in enumerate(changed.ids) if source_id in positions]
+        appends = [j for j, source_id in enumerate(changed.ids) if source_id not in positions]
+
+        if len(overwrites) > 0:
+            matrix = np.memmap(path + '.vectors', dtype=self.matrix.dtype, mode='r+', shape=self.matrix.shape)
+            for i, j in overwrites:
+                matrix[i] = changed.matrix[j]
+                self.titles[i] = changed.titles[j]
+                self.hashes[i] = changed.hashes[j]
+            matrix.flush()
+            del matrix
+
+        if len(appends) > 0:
+            with open(path + '.vectors', 'ab') as f:
+                f.write(np.ascontiguousarray(changed.matrix[appends], dtype=self.matrix.dtype).tobytes())
+            self.ids = self.ids + [changed.ids[j] for j in appends]
+            self.titles = self.titles + [changed.titles[j] for j in appends]
+            self.hashes = self.hashes + [changed.hashes[j] for j in appends]
+
+        self.write_header(path)
+        store = EmbeddingStore.load(path)
+        if store.matrix.shape[0] > 0 and len(store.deleted) > store.matrix.shape[0] * COMPACT_RATIO:
+            store = store.compact(path)
+        if self.quantized is not None:  # overwritten rows keep the row count, so always re-encode
+            store.quantize(path, self.quantized.kind, self.quantized.dims)
+        return store
+
+    def alive_hashes(self):
+        return {self.ids[i]: self.hashes[i] for i in range(len(self.ids)) if i not in self.deleted}
+
+    def field_weights(self, spec=None):
+        """
+        Parses per-field weights like `title: 2, artist: 1` (field names with or without `_embedding`, or a dict)
+        into an array over the store's fields that sums to 1. Fields left out get no weight, and no spec
+        weighs every field equally.
+        """
+        if not spec:
+            return np.full(len(self.fields), 1 / max(1, len(self.fields)), dtype=np.float32)
+        if isinstance(spec, str):
+            spec = {name.strip(): float(weight) for name, weight in
+                    (part.split(':', 1) for part in re.split(r'[,;]', spec) if part.strip())}
+        weights = np.zeros(len(self.fields), dtype=np.float32)
+        for name, weight in spec.items():
+            field = name if name in self.fields else f"{name}_embedding"
+            if field not in self.fields:
+                raise ValueError(f"No {name} embeddings in this store, it has {', '.join(self.fields)}")
+            weights[self.fields.index(field)] = weight
+        if weights.sum() <= 0:
+            raise ValueError(f"Field weights must add up to more than 0: {spec}")
+        return weights / weights.sum()
+
+    def query_matrix(self, vectors, weights=None):
+        """
+        Turns (m, dim) query embeddings into (m, fields * dim) rows that score against every block at once.
+        Each block is scaled by its field weight, given once (fields,) or per query (m, fields), so the
+        fused score is the weighted mean of the per-field cosine similarities.
+        """
+        queries = normalize_rows(np.atleast_2d(np.asarray(vectors, dtype=np.float32)))
+        if weights is None:
+            weights = self.field_weights()
+        weights = np.broadcast_to(np.asarray(weights, dtype=np.float32), (queries.shape[0], len(self.fields)))
+        return (weights[:, :, None] * queries[:, None, :]).reshape(queries.shape[0], -1)
+
+    def scores(self, vectors, weights=None):
+        """
+        Returns an (N, m) matrix of weighted per-field cosine similarities for m query embeddings.
+        """
+        scores = self.matrix @ self.query_matrix(vectors, weights).T
+        if len(self.deleted) > 0:
+            scores[sorted(self.deleted)] = -np.inf
+        return scores
+
+    def search(self, vectors, top_n=5, exact=False, weights=None, rerank=None):
+        """
+        Returns the top `top_n` row indices for each query, best first. Catalogues of at least
+        ANN_MIN_ROWS items use the IVF index when one was built; smaller ones are always scored exactly.
+
+        A quantized store scores its compressed codes instead, then re-scores the best `top_n * rerank`
+        candidates exactly from the float32 matrix (EMBEDDING_RERANK, 0 keeps the approximate order).
+        """
+        top_n = min(top_n, len(self))
+        if not exact and self.index is not None and len(self) >= self.ann_min_rows:
+            return self.index.search(self.matrix, self.query_matrix(vectors, weights), top_n, self.deleted)
+        if exact or self.quantized is None:
+            scores = self.scores(vectors, weights)
+            return [top_k(scores[:, i], top_n) for i in range(scores.shape[1])]
+
+        queries = self.query_matrix(vectors, weights)
+        scores = self.quantized.scores(queries)
+        if len(self.deleted) > 0:
+            scores[sorted(self.deleted)] = -np.inf
+        rerank = self.rerank if rerank is None else rerank
+        if rerank <= 0:
+            return [top_k(scores[:, i], top_n) for i in range(scores.shape[1])]
+        results = []
+        for i in range(scores.shape[1]):
+            candidates = np.sort(top_k(scores[:, i], top_n * rerank))
+            exact_scores = np.asarray(self.matrix[candidates], dtype=np.float32) @ queries[i]
+            results.append(candidates[top_k(exact_scores, top_n)])
+        return results
+
+    def records(self, indices, source_key=None, title_key=None):
+        source_key = source_key or self.source_key
+        title_key = title_key or self.title_key
+        return [{source_key: self.ids[i], title_key: self.titles[i]} for i in indices]
+
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    if k == 0:
+        return np.array([], dtype=int)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
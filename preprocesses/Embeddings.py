@@ -1,83 +1,244 @@
+import hashlib
 import json
 import os
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import openai
 import pandas as pd
-from openai import OpenAI
 from sklearn.decomposition import PCA
 from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.preprocessing import StandardScaler
 
-from .Utils import find_id_property
+from .Clients import get_openai
+from .EmbeddingCache import get_embedding_cache
+from .EmbeddingStore import EmbeddingStore, normalize_rows, store_path
+from .RateLimiter import get_rate_limiter
+from .Utils import find_id_property, count_tokens, load_records
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+MAX_BATCH_ITEMS = 2048  # inputs per embeddings.create request
+MAX_BATCH_TOKENS = 300000  # tokens summed across a request's inputs
+MAX_INPUT_TOKENS = 8191  # tokens per input
+META_COLUMNS = ['row_hash']  # bookkeeping columns that are never embedded
+
+
+def row_hash(record):
+    return hashlib.sha256(json.dumps(record, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def clean_text(value):
+    if value is None or isinstance(value, (list, dict)):
+        return None
+    if not isinstance(value, str) and pd.isna(value):
+        return None
+    text = str(value).replace("\n", " ")
+    return text if text.strip() else None
 
 
 class Embeddings:
-    def __init__(self, file_path):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_KEY"))
+    def __init__(self, file_path, client=None, incremental=False):
+        self.client = client or get_openai()
+        self.limiter = get_rate_limiter()
+        self.cache = get_embedding_cache()
         self.file_path = file_path
         self.products_df = None
+        self.store = None
         self.all_embeddings = {}
         self.source_key = 'source_id'
 
         if not os.path.exists(self.file_path):
             raise ValueError("Missing file: " + self.file_path)
-        elif self.file_path.endswith('.json'):
-            with open(self.file_path, 'r') as f:
-                data = json.load(f)
-                self.source_key = find_id_property(data[0])
+        elif self.file_path.endswith('.json') or self.file_path.endswith('.jsonl'):
+            data = load_records(self.file_path)
+            self.source_key = find_id_property(data[0])
             self.products_df = pd.DataFrame(data)
-            self._create_and_save_embeddings()
+            self.products_df['row_hash'] = [row_hash(record) for record in data]
+            if incremental:
+                self._update_embeddings()
+            else:
+                self._create_and_save_embeddings()
         elif self.file_path.endswith('.csv'):
             self.source_key = self.get_header_byindex(0)
             self.products_df = pd.read_csv(self.file_path)
-            self._create_and_save_embeddings()
-        elif self.file_path.endswith('.pkl'):
-            # WARN: source_id should have been forced by `DataIndexer.py`
+            self.products_df['row_hash'] = [row_hash(record) for record in self.products_df.to_dict(orient='records')]
+            if incremental:
+                self._update_embeddings()
+            else:
+                self._create_and_save_embeddings()
+        elif self.file_path.endswith('.emb') or self.file_path.endswith('.pkl'):
             self._load_embeddings()
         else:
-            raise ValueError("Unsupported file type. Please provide a .csv or .pkl file.")
+            raise ValueError("Unsupported file type. Please provide a .json, .jsonl, .csv, .emb or .pkl file.")
 
-    def _get_embedding(self, text, model="text-embedding-3-small"):
+    def _get_embedding(self, text, model=EMBEDDING_MODEL):
+        text = clean_text(text)
+        if text is None:
+            return None
+        if text not in self.all_embeddings:
+            self._embed_texts([text], model)
+        return self.all_embeddings.get(text)
+
+    def _pack_batches(self, texts, model):
+        batches = []
+        batch, batch_tokens = [], 0
+        for text in texts:
+            tokens = count_tokens(model, text)
+            if tokens > MAX_INPUT_TOKENS:
+                print(f'Skipping text over {MAX_INPUT_TOKENS} tokens: {text[:80]}...')
+                continue
+            if batch and (len(batch) >= MAX_BATCH_ITEMS or batch_tokens + tokens > MAX_BATCH_TOKENS):
+                batches.append((batch, batch_tokens))
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append((batch, batch_tokens))
+        return batches
+
+    def _embed_batch(self, batch, tokens, model):
+        """
+        Embeds one batch. The rate limiter already retries throttling and server errors, so a batch the
+        API rejects as bad input is split in half and retried to isolate the bad input. Any other error
+        (auth, permissions, quota) would fail every request the same way, so it's raised.
+        """
         try:
-            if text is None:
-                return None
-            elif not text or pd.isna(text):
-                return None
-            if isinstance(text, str):
-                text = text.replace("\n", " ")
-            print(f'creating openai embedding for {text}')
-            if text not in self.all_embeddings:
-                try:
-                    response = self.client.embeddings.create(input=text, model=model)
-                    self.all_embeddings[text] = response.data[0].embedding
-                except Exception as e:
-                    print(f'Embedding failed on : {text}', e)
-                    return 0
-
-            return self.all_embeddings[text]
+            response = self.limiter.call_sync(model, tokens, self.client.embeddings.with_raw_response.create,
+                                              input=batch, model=model)
+            return {batch[item.index]: item.embedding for item in response.data}
+        except openai.BadRequestError as e:
+            if len(batch) == 1:
+                print(f'Embedding failed on : {batch[0]}', e)
+                return {}
+            half = len(batch) // 2
+            results = self._embed_batch(batch[:half], count_tokens(model, ' '.join(batch[:half])), model)
+            results.update(self._embed_batch(batch[half:], count_tokens(model, ' '.join(batch[half:])), model))
+            return results
 
-        except Exception as e:
-            print(f'Embedding failed: {text}', e)
-            return None
+    def _embed_texts(self, texts, model=EMBEDDING_MODEL):
+        """
+        Embeds every distinct text not already in `all_embeddings` or the on-disk cache, packing them
+        into batches bounded by item and token limits and sending the batches concurrently.
+        """
+        pending = list(dict.fromkeys(text for text in texts if text and text not in self.all_embeddings))
+        if len(pending) == 0:
+            return self.all_embeddings
+
+        cached = self.cache.get_many(model, pending)
+        self.all_embeddings.update(cached)
+        pending = [text for text in pending if text not in cached]
+        if len(pending) == 0:
+            return self.all_embeddings
+
+        batches = self._pack_batches(pending, model)
+        print(f"Embedding {len(pending)} texts in {len(batches)} batches")
+        workers = int(os.getenv("EMBEDDING_WORKERS", 4))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._embed_batch, batch, tokens, model) for batch, tokens in batches]
+            for i, future in enumerate(futures):
+                results = future.result()
+                self.cache.put_many(model, results)
+                self.all_embeddings.update(results)
+                print(f"embedded batch {i + 1}/{len(batches)}")
+        return self.all_embeddings
+
+    def source_columns(self, df):
+        return [column for column in df.columns
+                if column != self.source_key and column not in META_COLUMNS and not column.endswith('_embedding')]
+
+    def embeddings_path(self):
+        return store_path(self.file_path)
+
+    def _embed_columns(self, df):
+        columns = self.source_columns(df)
+
+        # one pass over every column so repeated values (artists, genres, ...) are only embedded once
+        cleaned = {column: [clean_text(value) for value in df[column]] for column in columns}
+        self._embed_texts(text for values in cleaned.values() for text in values)
+
+        for column in columns:
+            df[column + '_embedding'] = [self.all_embeddings.get(text) if text else None for text in cleaned[column]]
+        return df
+
+    def _save_embeddings(self):
+        self.store = EmbeddingStore.from_dataframe(self.products_df, self.source_key, self.get_header_byindex(1),
+                                                   EMBEDDING_MODEL)  # Assumes 0 is id
+        self.store.save(self.embeddings_path())
 
     def _create_and_save_embeddings(self):
         print("Creating embeddings...")
-        column = None
-        try:
-            for column in self.products_df.columns:
-                if column != self.source_key:
-                    print(f"applying embedding: {column}")
-                    self.products_df[column + '_embedding'] = self.products_df[column].apply(self._get_embedding)
-        except Exception as e:
-            print(f'Embedding column failed: {column}', e)
+        self._embed_columns(self.products_df)
+        self._save_embeddings()
+        print("Embeddings created and saved.")
 
-        base, _ = os.path.splitext(self.file_path)
-        embeddings_file = base + '.pkl'
-        with open(embeddings_file, 'wb') as f:
-            pickle.dump(self.products_df, f)
+    def _convert_pickle(self, pkl_path):
+        """
+        Converts a pickled DataFrame from older builds into the memory-mapped store format.
+        """
+        print(f"Converting {pkl_path} to {self.embeddings_path()}...")
+        with open(pkl_path, 'rb') as f:
+            df = pickle.load(f)
+        # WARN: source_id should have been forced by `DataIndexer.py`
+        if self.source_key not in df.columns:
+            self.source_key = find_id_property({column: None for column in df.columns}) or df.columns[0]
+        if 'row_hash' not in df.columns:
+            fields = [column for column in df.columns if not column.endswith('_embedding')]
+            df['row_hash'] = [row_hash(record) for record in df[fields].to_dict(orient='records')]
+        EmbeddingStore.from_dataframe(df, self.source_key, df.columns[1], EMBEDDING_MODEL).save(self.embeddings_path())
 
-        print("Embeddings created and saved.")
+    def load_store(self):
+        path = self.embeddings_path()
+        base, _ = os.path.splitext(path)
+        pkl_path = base + '.pkl'
+        if os.path.exists(pkl_path) and (not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(pkl_path)):
+            self._convert_pickle(pkl_path)
+        if not os.path.exists(path):
+            return None
+        return EmbeddingStore.load(path)
+
+    def _update_embeddings(self):
+        """
+        Diffs the source rows against the existing embeddings by source id and row hash, embeds only
+        the inserted or changed rows, drops deleted ones and keeps everything else as it was.
+        """
+        key = self.source_key
+        existing = self.load_store()
+        if existing is None:
+            print("No existing embeddings to update")
+            return self._create_and_save_embeddings()
+
+        fields = [column + '_embedding' for column in self.source_columns(self.products_df)]
+        if existing.source_key != key or existing.fields != fields:
+            print("Dataset columns changed since the last build")
+            return self._create_and_save_embeddings()
+        if self.products_df[key].duplicated().any():
+            print(f"Duplicate {key} values, rows can't be matched")
+            return self._create_and_save_embeddings()
+
+        old_hashes = existing.alive_hashes()
+        changed_mask = np.array([old_hashes.get(source_id) != new_hash for source_id, new_hash in
+                                 zip(self.products_df[key], self.products_df['row_hash'])], dtype=bool)
+        changed = self.products_df[changed_mask].copy()
+        inserted = int(sum(1 for source_id in changed[key] if source_id not in old_hashes))
+        deleted = len(set(old_hashes.keys()) - set(self.products_df[key]))
+        print(f"{inserted} inserted, {len(changed) - inserted} changed, {deleted} deleted rows")
+
+        if len(changed) == 0 and deleted == 0:
+            self.store = existing
+            print("Embeddings are up to date.")
+            return
+
+        if len(changed) > 0:
+            embedded = EmbeddingStore.from_dataframe(self._embed_columns(changed), key, self.get_header_byindex(1),
+                                                     EMBEDDING_MODEL)
+        else:  # only deletions
+            embedded = EmbeddingStore(np.zeros((0, existing.matrix.shape[1]), dtype=np.float32), [], [],
+                                      existing.fields, existing.model, key, existing.title_key)
+        # deleted rows, plus changed rows whose new embeddings are incomplete
+        removed = (set(old_hashes.keys()) - set(self.products_df[key])) | (set(changed[key]) - set(embedded.ids))
+        self.store = existing.apply_changes(self.embeddings_path(), embedded, removed)
+        print("Embeddings updated in place.")
 
     def get_header_byindex(self, index):
         if ".csv" in self.file_path:
@@ -86,59 +247,74 @@ class Embeddings:
             if index < 0 or index >= len(headers):
                 raise IndexError("Index out of range")
             return headers[index]
+        elif self.products_df is not None:
+            return self.products_df.columns[index]
         else:
-            df = pd.read_pickle(self.file_path)
-            return df.columns[index]
+            return [self.get_store().source_key, self.get_store().title_key][index]
 
     def _load_embeddings(self):
         print("Loading embeddings from file...")
-        with open(self.file_path, 'rb') as f:
-            self.products_df = pickle.load(f)
+        self.store = self.load_store()
+        if self.store is None:
+            raise ValueError("Missing embeddings: " + self.embeddings_path())
+        self.source_key = self.store.source_key
         print("Embeddings loaded.")
 
+    def get_store(self):
+        if self.store is None:
+            self.store = EmbeddingStore.from_dataframe(self.products_df, self.source_key, self.get_header_byindex(1),
+                                                       EMBEDDING_MODEL)  # Assumes 0 is id
+        return self.store
+
     def find_recommendations_noopenai(self, user_answers, top_n=5):
         user_answers_scaled = StandardScaler().fit_transform(
             [user_answers])  # Assuming user_answers is a list of feature values
         pca = PCA(n_components=10)  # Should match the components used during embedding creation
         user_embedding = pca.fit_transform(user_answers_scaled)
 
-        embedding_columns = [col for col in self.products_df.columns if col.endswith('_embedding')]
-        product_embeddings = np.array([np.hstack(row) for row in self.products_df[embedding_columns].dropna().values])
-
-        similarities = cosine_similarity(user_embedding, product_embeddings)
+        store = self.get_store()
+        similarities = cosine_similarity(user_embedding, store.matrix)
         top_indices = np.argsort(similarities[0])[::-1][:top_n]
 
-        recommended_products = self.products_df.iloc[top_indices]
-
-        title_key = self.get_header_byindex(1)  # Assumes 0 is id
+        return pd.DataFrame(store.records(top_indices))
 
-        return recommended_products[[self.source_key, title_key]]
+    def find_recommendations(self, survey, top_n=5, model=None, weights=None):
+        return self.find_recommendations_batch([survey], top_n, model, weights)[0]
 
-    def find_recommendations(self, survey, top_n=5, model="text-embedding-3-small"):
-        # Create a combined embedding for the user's survey answers
-        user_embedding_parts = []
-        for column in self.products_df.columns:
-            if column != self.source_key and not column.endswith('_embedding'):
-                user_embedding_parts.append(self._get_embedding(survey.strip(), model))
-
-        user_embedding = np.hstack(user_embedding_parts)
+    def find_recommendations_batch(self, surveys, top_n=5, model=None, weights=None):
+        """
+        Scores many surveys against the catalogue with one matrix-matrix product.
 
+        A survey is one text, or a list of texts (like its question: answer pairs) that are embedded
+        separately and averaged, so each answer counts on its own. `weights` are per-field weights
+        (see EmbeddingStore.field_weights), once for every survey or as a list with one per survey.
+        Returns a list of recommendations (or None when a survey couldn't be embedded) in the order given.
+        """
+        parts = [[clean_text(text.strip()) for text in ([survey] if isinstance(survey, str) else survey)] for survey in surveys]
+        model = model or self.get_store().model or EMBEDDING_MODEL
         try:
-            # Combine all embeddings into a single array, keeping the original indices
-            embedding_columns = [col for col in self.products_df.columns if col.endswith('_embedding')]
-            valid_embeddings_df = self.products_df[embedding_columns].dropna()
-            product_embeddings = np.array([np.hstack(row) for row in valid_embeddings_df.values])
-
-            similarities = cosine_similarity([user_embedding], product_embeddings)
-            top_indices = np.argsort(similarities[0])[::-1][:top_n]
+            self._embed_texts([text for texts in parts for text in texts], model)
+            store = self.get_store()
+            if not isinstance(weights, list):
+                weights = [weights] * len(surveys)
 
-            recommended_products = self.products_df.iloc[valid_embeddings_df.index[top_indices]]
+            embedded, vectors = [], []
+            for i, texts in enumerate(parts):
+                found = [self.all_embeddings[text] for text in texts if self.all_embeddings.get(text) is not None]
+                if len(found) > 0:
+                    embedded.append(i)
+                    # the mean of normalized vectors scores the mean cosine similarity over the texts
+                    vectors.append(normalize_rows(np.array(found, dtype=np.float32)).mean(axis=0))
+            results = [None] * len(surveys)
+            if len(embedded) == 0:
+                return results
 
-            title_key = self.get_header_byindex(1) # Assumes 0 is id
-
-            recommendations = recommended_products[[self.source_key, title_key]].to_dict(orient='records')
-            return recommendations
+            title_key = self.get_header_byindex(1)  # Assumes 0 is id
+            fused = np.array([store.field_weights(weights[i]) for i in embedded], dtype=np.float32)
+            for i, indices in zip(embedded, store.search(np.array(vectors), top_n, weights=fused)):
+                results[i] = store.records(indices, self.source_key, title_key)
+            return results
         except Exception as e:
-            print(f'Recs failed: {survey}', e)
-            return None
+            print(f'Recs failed: {surveys}', e)
+            return [None] * len(surveys)
 
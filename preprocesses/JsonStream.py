@@ -0,0 +1,73 @@
+import json
+
+
+class JsonArrayStream:
+    """
+    Parses a JSON array out of streamed text as it arrives: `feed` returns each element as soon as it is
+    complete, so items can be checked before the response ends. Like find_json, text before the first
+    bracket is skipped, and a response whose first bracket is `{` isn't an array, so it yields nothing.
+    """
+
+    def __init__(self):
+        self.buffer = ''  # only the text of the element being streamed is kept
+        self.position = 0
+        self.item_start = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.state = 'before'  # 'array' once the first bracket is `[`, 'closed' once it's matched, 'skipped' for `{`
+        self.items = []
+
+    @property
+    def closed(self):
+        return self.state == 'closed'
+
+    def feed(self, text):
+        if self.state in ['closed', 'skipped']:
+            return []
+        self.buffer += text
+        items = []
+        while self.position < len(self.buffer) and self.state in ['before', 'array']:
+            char = self.buffer[self.position]
+            self.position += 1
+            if self.state == 'before':
+                if char == '[':
+                    self.state = 'array'
+                    self.depth = 1
+                elif char == '{':
+                    self.state = 'skipped'
+                self.item_start = self.position
+            elif self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '[{':
+                self.depth += 1
+            elif char in ']}':
+                self.depth -= 1
+                if self.depth == 0:
+                    items += self.element(self.position - 1)
+                    self.state = 'closed'
+            elif char == ',' and self.depth == 1:
+                items += self.element(self.position - 1)
+                self.item_start = self.position
+
+        self.buffer = self.buffer[self.item_start:]
+        self.position -= self.item_start
+        self.item_start = 0
+        self.items += items
+        return items
+
+    def element(self, end):
+        text = self.buffer[self.item_start:end].strip()
+        if len(text) == 0:
+            return []
+        try:
+            return [json.loads(text)]
+        except json.JSONDecodeError:
+            return []  # not valid JSON, find_json on the whole response reports it
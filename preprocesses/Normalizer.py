@@ -0,0 +1,161 @@
+import csv
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+from .Utils import sanitize_header, cast_to_boolean, convert_to_number
+
+SAMPLE_ROWS = 1000
+BOOLEAN_VALUES = ['true', 'false', 'yes', 'no', '1', '0']
+
+
+def read_header(file_path):
+    """
+    Returns the sanitized header row and the byte offset where the data rows start.
+    """
+    with open(file_path, 'rb') as f:
+        line = f.readline()
+        return next(csv.reader([line.decode('utf-8-sig')])), f.tell()
+
+
+def read_raw_lines(file_path, start, end):
+    """
+    Yields the lines that start inside [start, end), so byte ranges split a file without sharing or losing lines.
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(start - 1)
+        if f.read(1) != b'\n':
+            f.readline()  # the previous range owns the line we landed in
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+
+def read_lines(file_path, start, end):
+    for line in read_raw_lines(file_path, start, end):
+        yield line.decode('utf-8')
+
+
+def spans_lines(file_path, start, end):
+    """
+    True if a quoted value in [start, end) contains a line break. Quotes inside a value are doubled, so a
+    line only leaves a value open when it has an odd number of them; that makes the check line-local.
+    """
+    return any(line.count(b'"') % 2 == 1 for line in read_raw_lines(file_path, start, end))
+
+
+def infer_type(values):
+    values = [value for value in values if value != '']
+    if len(values) == 0:
+        return 'str'
+    for name, cast in (('int', int), ('float', float)):
+        try:
+            for value in values:
+                cast(value)
+            return name
+        except ValueError:
+            pass
+    if all(value.lower() in BOOLEAN_VALUES for value in values):
+        return 'bool'
+    return 'str'
+
+
+def infer_types(file_path, start, headers):
+    """
+    Infers each column's type from the first SAMPLE_ROWS rows.
+    """
+    columns = [[] for _ in headers]
+    for i, row in enumerate(csv.reader(read_lines(file_path, start, os.path.getsize(file_path)))):
+        if i >= SAMPLE_ROWS:
+            break
+        for j, value in enumerate(row[:len(headers)]):
+            columns[j].append(value)
+    return [infer_type(values) for values in columns]
+
+
+def cast_value(value, column_type):
+    if value is None or value == '' or column_type == 'str':
+        return value
+    try:
+        if column_type == 'int':
+            return int(value)
+        if column_type == 'float':
+            return float(value)
+    except ValueError:
+        return convert_to_number(value)  # a value the sample didn't see
+    return cast_to_boolean(value)
+
+
+def normalize_range(file_path, start, end, headers, types, out_path, jsonl=False, wrap=False):
+    """
+    Writes the rows of one byte range to `out_path`, as JSON lines or comma separated objects
+    (a whole JSON array when `wrap`). Returns the number of rows written.
+    """
+    count = 0
+    with open(out_path, 'w', encoding='utf-8') as out:
+        if wrap:
+            out.write('[')
+        for row in csv.reader(read_lines(file_path, start, end)):
+            if len(row) == 0:
+                continue
+            row = row + [None] * (len(headers) - len(row))  # like DictReader, missing values are null
+            record = {header: cast_value(value, column_type) for header, column_type, value in zip(headers, types, row)}
+            if jsonl:
+                out.write(json.dumps(record) + '\n')
+            else:
+                out.write((',\n' if count > 0 else '\n') + json.dumps(record))
+            count += 1
+        if wrap:
+            out.write('\n]')
+    return count
+
+
+def byte_ranges(start, size, workers):
+    step = max(1, (size - start) // workers)
+    bounds = [start + i * step for i in range(workers)] + [size]
+    return [(bounds[i], bounds[i + 1]) for i in range(workers) if bounds[i] < bounds[i + 1]]
+
+
+def normalize_csv(file_path, source_key, out_path, jsonl=False, workers=1):
+    """
+    Streams a CSV into JSON (or JSON lines) without holding it in memory. Headers are sanitized once and
+    `source_key` renamed to `source_id`; column types are inferred from a sample. With `workers` > 1 the
+    file is split into byte ranges normalized by separate processes, then concatenated in order. The whole
+    file is first checked (by the same workers) for values that span lines, which can't be split that way.
+    """
+    header, start = read_header(file_path)
+    headers = [sanitize_header(key).replace(source_key, "source_id") for key in header]
+    types = infer_types(file_path, start, headers)
+    size = os.path.getsize(file_path)
+    if workers <= 1:
+        return normalize_range(file_path, start, size, headers, types, out_path, jsonl, wrap=not jsonl)
+
+    ranges = byte_ranges(start, size, workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if any(executor.map(spans_lines, [file_path] * len(ranges), [r[0] for r in ranges], [r[1] for r in ranges])):
+            print('Values span multiple lines, so the file can\'t be split by byte range. Using one worker')
+            return normalize_range(file_path, start, size, headers, types, out_path, jsonl, wrap=not jsonl)
+
+        parts = [f"{out_path}.part{i}" for i in range(len(ranges))]
+        counts = list(executor.map(normalize_range, [file_path] * len(ranges), [r[0] for r in ranges],
+                                   [r[1] for r in ranges], [headers] * len(ranges), [types] * len(ranges),
+                                   parts, [jsonl] * len(ranges)))
+
+    with open(out_path, 'w', encoding='utf-8') as out:
+        if not jsonl:
+            out.write('[')
+        written = 0
+        for part, count in zip(parts, counts):
+            if count > 0:
+                with open(part, 'r', encoding='utf-8') as f:
+                    if not jsonl and written > 0:
+                        out.write(',')  # each part starts with its own newline
+                    shutil.copyfileobj(f, out)
+                written += count
+            os.remove(part)
+        if not jsonl:
+            out.write('\n]')
+    return written
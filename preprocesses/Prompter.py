@@ -1,27 +1,44 @@
+import asyncio
 import copy
 import datetime
 import json
 import os
 import sys
+import time
 
-import pandas
+import openai
 from dotenv import load_dotenv
 from loguru import logger
-from openai import AssistantEventHandler
-from openai import OpenAI
-import tiktoken
+from openai import AsyncAssistantEventHandler
 
-from .Embeddings import Embeddings
-from .Utils import find_id_property, find_json, adler32, stringify_survey, find_nearby_file
+from .Clients import get_async_openai, get_openai
+from .DatasetIndex import load_dataset_index, normalize_id
+from .DatasetRegistry import get_registry
+from .JsonStream import JsonArrayStream
+from .RateLimiter import get_rate_limiter
+from .ResultsStore import get_results_store, result_key, results_dir
+from .UploadCache import get_upload_cache, hash_options
+from .Utils import find_id_property, find_json, adler32, stringify_survey, count_tokens, context_limit
 
 load_dotenv()
 
+# kept free for the answer when a dataset is split to fit the context window
+RESPONSE_TOKENS = int(os.getenv("COMPLETION_RESPONSE_TOKENS", 2048))
+
+USERDATA_REFERENCE = "the user data given with the request"
+USERDATA_BLOCK = "User data: \n\n {}"
+
 
 class Prompter:
-    def __init__(self, prompt, config, survey):
+    def __init__(self, prompt, config, survey, client=None, repeat=0):
         self.prompt = prompt
         self.config = config
-        self.openai = OpenAI(api_key=os.getenv("OPENAI_KEY"))
+        self.repeat = repeat
+        self.openai = client or get_async_openai()
+        self.limiter = get_rate_limiter()
+        self.uploads = get_upload_cache()
+        self.datasets = get_registry()
+        self.results = get_results_store()
 
         self.file = None
         self.thread = None
@@ -31,7 +48,7 @@ class Prompter:
         if self.config["file_path"] is None or self.config["file_path"] == '':
             logger.info(f"no file or dataset being referenced")
         elif os.path.exists(self.config["file_path"]):
-            if ".pkl" not in self.config["file_path"] and ".json" not in self.config["file_path"]:  # csv can be retrieved: https://platform.openai.com/docs/assistants/tools/file-search/supported-files
+            if ".pkl" not in self.config["file_path"] and ".emb" not in self.config["file_path"] and ".json" not in self.config["file_path"]:  # csv can be retrieved: https://platform.openai.com/docs/assistants/tools/file-search/supported-files
                 logger.critical(f"Check OpenAI's docs if they're supporting this filetype: https://platform.openai.com/docs/assistants/tools/file-search/supported-files. Also try running `python DatIandexer.py normalize_dataset <product_file> <source_key>`")
                 sys.exit(1)
 
@@ -52,6 +69,10 @@ class Prompter:
         if "__FILENAME__" in self.prompt["instruction"]:
             self.prompt["instruction"] = self.prompt["instruction"].replace('__FILENAME__', os.path.basename(self.config['file_path']))
 
+        # the instructions as written, for prompt layouts that keep survey answers out of the shared prefix
+        self.instruction_template = self.prompt["instruction"]
+        self.survey_in_instructions = "__USERDATA__" in self.prompt["instruction"]
+
         if "__USERDATA__" not in self.prompt["prompt"] and "__USERDATA__" not in self.prompt["instruction"]:
             self.survey = False
             self.survey_str = ""
@@ -84,12 +105,12 @@ class Prompter:
         else:
             self.opts_assistant["name"] += " - " + self.test_id
 
-        results_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', os.getenv("RESULTS_DIR")))
-        if not os.path.exists(results_dir):
-            os.makedirs(results_dir)
-
-        self.results_path = f'{results_dir}/result-{self.test_id}.json'
+        self.results_path = f'{results_dir()}/result-{self.test_id}.json'  # written by older versions
         self.opts_run = {}
+        self.usage = None
+        self.batch_size = None
+        self.timings = {}  # streamed runs: time to first token and stream time, in seconds like ms
+        self.stopped_early = False
 
     async def complete(self):
         self.started = datetime.datetime.now()
@@ -103,103 +124,195 @@ class Prompter:
             await self.create_thread()
             await self.run_thread()
         elif self.config["executable"] == 'Embeddings':
-            self.create_embeddings()
+            await self.create_embeddings()
         else:
             await self.run_completion()
 
     async def run_completion(self):
         self.started = datetime.datetime.now()
+        model = self.config["model"]
 
-        message = [{"role": "system", "content": self.opts_assistant["instructions"]}]
-
-        if self.config["file_path"]:
-            f = open(self.config["file_path"], "r")
-            content = f.read()
-
-            message.append(
-                {"role": "system", "content": f"Make your recommendation based on this data: \n\n {content}"})
+        data = self.datasets.prompt(self.config["file_path"]) if self.config["file_path"] else None
+        message = self.completion_messages(data)
 
-        message.append({"role": "user", "content": self.opts_thread["messages"][0]["content"]})
+        total_tokens = self.count_total_tokens(model, message)
+        limit = context_limit(model)
+        if total_tokens > limit and self.config.get("chunking") and self.config["file_path"]:
+            budget = limit - self.count_total_tokens(model, self.completion_messages(None)) - RESPONSE_TOKENS
+            chunks = self.datasets.chunks(self.config["file_path"], model, budget) if budget > 0 else None
+            if chunks is not None:
+                return await self.run_chunked_completion(chunks)
 
-        total_tokens = self.count_total_tokens(self.config["model"], message)
-        if total_tokens > 16385:
-            msg = f"Too many tokens: {self.get_config_id()} ({self.test_id}) measured {total_tokens} tokens"
+        if total_tokens > limit:
+            msg = f"Too many tokens: {self.get_config_id()} ({self.test_id}) measured {total_tokens} of {limit} tokens"
             logger.critical(msg)
             self.ended = datetime.datetime.now()
-            self.validate_response(None, msg)
+            await self.validate_response(None, msg, error=msg)
         else:
             try:
-                response_str = self.openai.chat.completions.create(
-                    model=self.opts_assistant['model'],
-                    messages=message
-                )
+                response_str = await self.create_completion(message, total_tokens)
                 self.ended = datetime.datetime.now()
-                response_str = response_str.choices[0].message.content
                 # get_nested(response_str, ['choices', 0, 'message', 'content'], default=json.dumps(response_str, indent=2))
                 logger.debug(f"\nCOMPLETION RESULTS:\n {response_str}")
                 response_json = find_json(response_str)
-                self.validate_response(response_json, response_str)
+                await self.validate_response(response_json, response_str)
             except Exception as e:
                 self.ended = datetime.datetime.now()
                 logger.error(f"Completion Failed: {e}")
-                self.validate_response(None, str(e))
+                await self.validate_response(None, str(e), error=str(e))
+
+    def completion_messages(self, data):
+        """
+        The chat messages for a Completion run around a dataset prompt block (or None).
+
+        With the `static_first` config, the dataset and the instructions as written lead and the survey
+        answers move into the final message, so every cell of a prompt shares one long prefix that the
+        provider's prompt cache can reuse.
+        """
+        if not self.config.get("static_first"):
+            message = [{"role": "system", "content": self.opts_assistant["instructions"]}]
+            if data:
+                message.append({"role": "system", "content": data})
+            message.append({"role": "user", "content": self.opts_thread["messages"][0]["content"]})
+            return message
+
+        message = [{"role": "system", "content": data}] if data else []
+        message.append({"role": "system", "content": self.instruction_template.replace('__USERDATA__', USERDATA_REFERENCE)})
+        question = self.opts_thread["messages"][0]["content"]
+        if self.survey_in_instructions and self.survey_str:
+            question += "\n\n" + USERDATA_BLOCK.format(self.survey_str)
+        message.append({"role": "user", "content": question})
+        return message
+
+    async def create_completion(self, message, total_tokens):
+        response = await self.limiter.call(self.opts_assistant['model'], total_tokens,
+                                           self.openai.chat.completions.with_raw_response.create,
+                                           model=self.opts_assistant['model'],
+                                           messages=message)
+        self.add_usage(response.usage)
+        return response.choices[0].message.content
+
+    def add_usage(self, usage):
+        """
+        Sums token usage over a cell's API calls, including the prompt tokens served from the provider's cache.
+        """
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        if isinstance(details, dict):
+            cached = details.get('cached_tokens')
+        else:
+            cached = getattr(details, 'cached_tokens', None)
+        if self.usage is None:
+            self.usage = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+        self.usage["prompt_tokens"] += getattr(usage, 'prompt_tokens', None) or 0
+        self.usage["completion_tokens"] += getattr(usage, 'completion_tokens', None) or 0
+        self.usage["cached_tokens"] += cached or 0
+
+    async def run_chunked_completion(self, chunks):
+        """
+        Asks the same question of each chunk of an oversized dataset concurrently (the rate limiter paces
+        them) and merges the JSON answers into one response.
+        """
+        logger.info(f"Splitting {self.config['file_path']} into {len(chunks)} chunks for {self.config['model']}")
+        messages = [self.completion_messages(chunk) for chunk in chunks]
+        try:
+            responses = await asyncio.gather(*[self.create_completion(message, self.count_total_tokens(self.config["model"], message))
+                                               for message in messages])
+            self.ended = datetime.datetime.now()
+            response_str = "\n\n".join(responses)
+            logger.debug(f"\nCHUNKED COMPLETION RESULTS:\n {response_str}")
+            response_json = merge_chunk_results([find_json(response) for response in responses], self.config.get("top_n"))
+            await self.validate_response(response_json, response_str)
+        except Exception as e:
+            self.ended = datetime.datetime.now()
+            logger.error(f"Chunked Completion Failed: {e}")
+            await self.validate_response(None, str(e), error=str(e))
 
     def count_total_tokens(self, model_name, messages):
-        # Load the tokenizer for the specified model
-        encoding = tiktoken.encoding_for_model(model_name)
-
         total_tokens = 0
 
         # Encode each message and accumulate the token count
         for message in messages:
-            total_tokens += len(encoding.encode(message['content']))
+            total_tokens += count_tokens(model_name, message['content'])
 
         return total_tokens
 
+    async def call_files(self, fn, *args, **kwargs):
+        # file, vector store, assistant and thread management calls share one request-only bucket
+        return await self.limiter.call('files', 0, fn, *args, **kwargs)
+
+    async def reuse_or_create(self, kind, key, retrieve, create, is_valid=None):
+        """
+        Returns the cached artifact for `key` while it is still valid, otherwise creates and records a new one.
+        Concurrent cells wait on the same key so the artifact is only built once.
+        """
+        async with self.uploads.lock(kind, key):
+            entry = self.uploads.get(kind, key)
+            if entry:
+                try:
+                    obj = await self.call_files(retrieve, entry["id"])
+                    if is_valid is None or is_valid(obj):
+                        logger.info(f"Reusing {kind} {entry['id']}")
+                        return obj
+                except openai.NotFoundError:
+                    pass
+                logger.info(f"Cached {kind} {entry['id']} is no longer valid")
+                self.uploads.invalidate(kind, key)
+
+            obj = await create()
+            self.uploads.set(kind, key, {"id": obj.id, "file_path": self.config["file_path"]})
+            return obj
+
     async def create_file(self):
         if self.config["file_path"] == "":
             return None
         elif self.config["file_path"][0:5] == 'file-':
-            self.file = self.openai.files.retrieve(self.config["file_path"])
+            self.file = await self.call_files(self.openai.files.retrieve, self.config["file_path"])
         elif os.path.exists(self.config["file_path"]) is False:
-            files = self.openai.files.list()
-            for file in files:
-                if file.filename == os.path.basename(self.config["file_path"]):
-                    self.file = file
-                    break
+            self.file = await self.find_uploaded_file()
         else:
-            self.file = self.openai.files.create(file=open(self.config["file_path"], 'rb'), purpose="assistants")
+            async def upload():
+                with open(self.config["file_path"], 'rb') as f:
+                    content = (os.path.basename(self.config["file_path"]), f.read())  # bytes, so a retry re-sends the whole file
+                return await self.call_files(self.openai.files.create, file=content, purpose="assistants")
+
+            key = hash_options(self.uploads.content_hash(self.config["file_path"]), "assistants")
+            self.file = await self.reuse_or_create('file', key, self.openai.files.retrieve, upload,
+                                                   lambda file: file.status != 'error')
 
         if self.file is None:
             logger.warning(f"Failed to get file: {self.config['file_path']}")
 
 
-    def get_dataset(self):
+    async def get_dataset(self):
         if self.file and self.file.purpose == 'assistants':  # cannot download these
-            file_path = find_nearby_file(self.file.filename,
-                                         os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-            if len(file_path) > 0:
-                with open(file_path, 'r') as file:
-                    return json.load(file)
+            file_path = self.datasets.resolve(self.file.filename)
+            if file_path:
+                return self.datasets.records(file_path)
         elif self.file and self.file.purpose != 'assistants':  # cannot download these
-            return self.openai.files.content(self.file.id)
+            return await self.call_files(self.openai.files.content, self.file.id)
         elif self.config["file_path"][0:5] == 'file-':
-            return self.openai.files.content(self.config["file_path"])
+            return await self.call_files(self.openai.files.content, self.config["file_path"])
         elif os.path.exists(self.config["file_path"]) is False:
-            files = self.openai.files.list()
-            for file in files:
-                if file.filename == os.path.basename(self.config["file_path"]):
-                    return self.openai.files.content(self.file.id)
-        elif ".csv" in self.config["file_path"]:
-            with open(self.config["file_path"], 'r') as file:
-                df = pandas.read_csv(self.config["file_path"])  # Read only the header row
-                return df.columns.tolist()
-        elif ".json" in self.config["file_path"]:
-            with open(self.config["file_path"], 'r') as file:
-                return json.load(file)
-        elif ".pkl" in self.config["file_path"]:
-            df = pandas.read_pickle(self.config["file_path"])
-            return df.to_dict(orient='records')
+            file = await self.find_uploaded_file()
+            if file is not None:
+                return await self.call_files(self.openai.files.content, file.id)
+        else:
+            return self.datasets.records(self.config["file_path"])
+
+    async def find_uploaded_file(self):
+        # the files list isn't paginated, so one rate limited call returns every uploaded file
+        files = await self.call_files(self.openai.files.list)
+        name = os.path.basename(self.config["file_path"])
+        return next((file for file in files.data if file.filename == name), None)
+
+    def get_dataset_name(self):
+        if self.file is not None:
+            return self.file.id
+        if os.path.exists(self.config["file_path"]):
+            return str(self.datasets.signature(self.config["file_path"]))  # a new mtime gets a new index
+        return self.config["file_path"]
 
     async def create_assistant(self):
         self.opts_assistant['tools'] = []
@@ -214,67 +327,72 @@ class Prompter:
             self.opts_assistant['tool_resources']['file_search'] = {"vector_store_ids": [self.vector.id]}
 
         if type(self.config["assistant"]) is str and self.config["assistant"][0:len("asst_")] == 'asst_':
-            self.assistant = self.openai.beta.assistants.retrieve(self.config["assistant"])
+            self.assistant = await self.call_files(self.openai.beta.assistants.retrieve, self.config["assistant"])
         else:
-            self.assistant = self.openai.beta.assistants.create(**self.opts_assistant)
+            key = hash_options(self.opts_assistant["model"], self.opts_assistant["instructions"],
+                               self.opts_assistant["tools"], self.opts_assistant["tool_resources"])
+            self.assistant = await self.reuse_or_create('assistant', key, self.openai.beta.assistants.retrieve,
+                                                        lambda: self.call_files(self.openai.beta.assistants.create,
+                                                                                **self.opts_assistant))
 
         if self.vector is not None and self.config["file_search"]:
-            self.openai.beta.assistants.update(self.assistant.id,
-                                               tool_resources={"file_search": {
-                                                   "vector_store_ids": [self.vector.id]}}
-                                               )
+            await self.call_files(self.openai.beta.assistants.update, self.assistant.id,
+                                  tool_resources={"file_search": {
+                                      "vector_store_ids": [self.vector.id]}}
+                                  )
             if self.thread is not None and "id" in self.thread:
-                self.openai.beta.threads.update(self.thread.id,
-                                                tool_resources={
-                                                    "file_search": {"vector_store_ids": [self.vector.id]}})
+                await self.call_files(self.openai.beta.threads.update, self.thread.id,
+                                      tool_resources={
+                                          "file_search": {"vector_store_ids": [self.vector.id]}})
 
     async def create_thread(self):
         if "thread" in self.config and self.config["thread"][0:7] == 'thread_':
-            self.thread = await self.openai.beta.threads.retrieve(self.config["thread"])
+            self.thread = await self.call_files(self.openai.beta.threads.retrieve, self.config["thread"])
         else:
             if self.config["code_interpreter"] or self.config["file_search"]:
                 self.opts_thread['messages'][0]['attachments'] = [
                     {"file_id": self.file.id, "tools": self.opts_assistant['tools']}]
-            self.thread = self.openai.beta.threads.create(**self.opts_thread)
+            self.thread = await self.call_files(self.openai.beta.threads.create, **self.opts_thread)
 
     async def create_vector_store(self):
         if self.file is None or hasattr(self.file, "id") is False:
             return None
         if "vector_store" in self.config and isinstance(self.config["vector_store"], str) and self.config["vector_store"][0:3] == 'vs_':
-            self.vector = self.openai.beta.vector_stores.retrieve(self.config["vector_store"])
-            current_timestamp = int(datetime.datetime.now().timestamp())
-            if current_timestamp < self.vector.expires_at:
+            self.vector = await self.call_files(self.openai.beta.vector_stores.retrieve, self.config["vector_store"])
+            if vector_store_is_active(self.vector):
 
                 if "assistant" in self.config and self.config["assistant"][0:5] == 'asst_':
-                    self.openai.beta.assistants.update(self.config["assistant"],
-                                                       tool_resources={"file_search": {
-                                                           "vector_store_ids": [self.vector.id]}}
-                                                       )
+                    await self.call_files(self.openai.beta.assistants.update, self.config["assistant"],
+                                          tool_resources={"file_search": {
+                                              "vector_store_ids": [self.vector.id]}}
+                                          )
 
                 if "thread" in self.config and self.config["thread"][0:5] == 'thread_':
-                    self.openai.beta.threads.update(
+                    await self.call_files(
+                        self.openai.beta.threads.update,
                         self.config["thread"],
                         tool_resources={"file_search": {"vector_store_ids": [self.vector.id]}},
                     )
 
                 return self.vector
 
-        self.vector = self.openai.beta.vector_stores.create(name=f"Vector Store {self.config['file_path']}",
-                                                            file_ids=[self.file.id],
-                                                            expires_after={"anchor": "last_active_at", "days": 7})
+        key = hash_options(self.file.id, "last_active_at", 7)
+        self.vector = await self.reuse_or_create('vector_store', key, self.openai.beta.vector_stores.retrieve,
+                                                 lambda: self.call_files(self.openai.beta.vector_stores.create,
+                                                                         name=f"Vector Store {self.config['file_path']}",
+                                                                         file_ids=[self.file.id],
+                                                                         expires_after={"anchor": "last_active_at", "days": 7}),
+                                                 vector_store_is_active)
         return self.vector
 
-    def create_embeddings(self):
-        self.started = datetime.datetime.now()
-        if ".pkl" not in self.config["file_path"]:
-            return logger.critical("\nFirst create your PKL file! :\n")
-        self.embeddings = Embeddings(self.config["file_path"])
-        topass = self.survey_str if self.survey_str else self.prompt["prompt"]
-        # TODO: maybe pass survey and create individual embeddings for each question:answer
-        response_json = self.embeddings.find_recommendations(topass)
-        self.ended = datetime.datetime.now()
-        logger.debug("\n\nEMBEDDING RESULT: {}\n", json.dumps(response_json))
-        self.validate_response(response_json, response_json)
+    async def create_embeddings(self):
+        await run_embeddings_batch([self])
+
+    def embedding_input(self):
+        # with Per Question, each question: answer pair is embedded and scored on its own
+        if self.config.get("per_question") and self.survey:
+            return [f"{question}: {answer}" for question, answer in self.survey.items()]
+        return self.survey_str if self.survey_str else self.prompt["prompt"]
 
     async def run_thread(self):
         if self.assistant:
@@ -282,34 +400,92 @@ class Prompter:
         else:
             self.opts_run["instructions"] = self.opts_assistant["instructions"]
 
-        event_handler = EventHandler()
-
         self.opts_run['thread_id'] = self.thread.id
-        with self.openai.beta.threads.runs.stream(
-                **self.opts_run,
-                event_handler=event_handler,
-        ) as stream:
-            stream.until_done()
+        tokens = self.count_total_tokens(self.opts_assistant["model"], [{"content": self.opts_assistant["instructions"]},
+                                                                        self.opts_thread["messages"][0]])
+
+        index = await self.stream_index()
+        top_n = int(self.config.get("top_n") or 0)
+
+        async def stream_run():
+            found = []
+            keys = []  # the first item's id property, as validate_response picks it
+
+            def on_item(item):
+                # each array item is checked against the dataset as soon as it's streamed
+                if len(keys) == 0:
+                    keys.append(find_id_property(item) if isinstance(item, dict) else None)
+                if index is not None and self.check_item(index, item, keys[0]):
+                    found.append(item)
+
+            event_handler = EventHandler(on_item)  # a fresh handler per attempt so retried deltas aren't duplicated
+            self.stopped_early = False
+            async with self.openai.beta.threads.runs.stream(
+                    **self.opts_run,
+                    event_handler=event_handler,
+            ) as stream:
+                async for _ in stream:
+                    if top_n and len(found) >= top_n:
+                        self.stopped_early = True
+                        break
+            if self.stopped_early:
+                await self.cancel_run(event_handler.current_run)
+            self.add_usage(getattr(event_handler.current_run, 'usage', None))
+            self.timings = event_handler.timings()
+            return event_handler
+
+        event_handler = await self.limiter.call(self.opts_assistant["model"], tokens, stream_run)
+        response_str = event_handler.response()
 
-            response_str = event_handler.response()
+        self.ended = datetime.datetime.now()
+        logger.debug("THREAD RESULTS!!: {}", response_str)
+        if self.stopped_early or event_handler.stream.closed:
+            # the items the stream parsed, already validated (a cancelled response isn't complete JSON)
+            await self.validate_response(event_handler.stream.items, response_str, validated=index is not None)
+        else:
+            await self.validate_response(find_json(response_str), response_str)
 
-            self.ended = datetime.datetime.now()
-            logger.debug("THREAD RESULTS!!: {}", response_str)
-            response_json = find_json(response_str)
-            self.validate_response(response_json, response_str)
+    async def stream_index(self):
+        if not self.config["file_path"]:
+            return None
+        try:
+            return await load_dataset_index(self.get_dataset_name(), self.get_dataset)
+        except Exception as e:
+            logger.error("Could not validate from dataset: {}", str(e))
+            return None
 
-    def validate_response(self, response_json, response_str=''):
-        tracker = {}
-        if os.path.exists(self.results_path):
-            with open(self.results_path, 'r') as file:
-                tracker = json.load(file)
+    async def cancel_run(self, run):
+        """
+        Stops a run that already streamed `top_n` items that exist, so it doesn't spend tokens on the rest.
+        """
+        if run is None:
+            return
+        try:
+            await self.call_files(self.openai.beta.threads.runs.cancel, run.id, thread_id=self.thread.id)
+            logger.info(f"Stopped {self.test_id} after {self.config.get('top_n')} items")
+        except openai.APIError as e:
+            logger.warning(f"Could not cancel run {run.id}: {e}")  # it may have finished meanwhile
+
+    def has_result(self):
+        """
+        True when this cell (and repeat) already has a result that didn't fail, so a resumed run can skip it.
+        """
+        result = self.results.get(self.test_id, self.get_config_id(), self.repeat)
+        if result is None and os.path.exists(self.results_path):
+            try:
+                with open(self.results_path, 'r') as file:
+                    result = json.load(file).get(self.get_result_id())
+            except (OSError, ValueError):
+                return False
+        return result is not None and not result.get("error")
 
-        config_id = self.get_config_id()
-        if config_id not in tracker:
-            tracker[config_id] = {}
+    def get_result_id(self):
+        return result_key(self.get_config_id(), self.repeat)
 
-        tracker[config_id] = {
+    async def validate_response(self, response_json, response_str='', error=None, validated=False):
+        result = {
             "ms": (self.ended - self.started).total_seconds(),
+            **self.timings,
             "started": self.started.strftime('%Y-%m-%d %H:%M:%S'),
             "ended": self.ended.strftime('%Y-%m-%d %H:%M:%S'),
             "model": self.opts_assistant["model"],
@@ -320,45 +496,74 @@ class Prompter:
             "config": copy.deepcopy(self.config), # because changes below mutate the config object from main.py
         }
 
+        if self.repeat > 0:
+            result["repeat"] = self.repeat
+
+        if error is not None:
+            result["error"] = error
+
+        if self.usage is not None:
+            result["usage"] = self.usage
+
+        if self.batch_size is not None:
+            result["batch_size"] = self.batch_size  # ms covers the whole batch
+
+        if self.stopped_early:
+            result["stopped_early"] = True
+
         if self.survey_str and len(self.survey_str) > 0:
-            tracker[config_id]["survey_id"] = adler32(self.survey_str)
+            result["survey_id"] = adler32(self.survey_str)
 
         tests = {"file_id": self.file, "thread_id": self.thread, "assistant_id": self.assistant,
                  "vector_store_id": self.vector}
         for key, obj in tests.items():
             if obj is not None and "id" in obj:
-                tracker[config_id]['config'][key] = obj["id"]
+                result['config'][key] = obj["id"]
             elif obj is not None and hasattr(obj, 'id'):
-                tracker[config_id]['config'][key] = obj.id
+                result['config'][key] = obj.id
 
         unsets = ['assistant', 'file_search', 'vector_store', 'code_interpreter']
         for u in unsets:
-            del tracker[config_id]['config'][u]
+            del result['config'][u]
 
-        tracker[config_id]["results"] = response_str if isinstance(response_str, str) and len(
+        result["results"] = response_str if isinstance(response_str, str) and len(
             response_str) > 0 else response_json
 
         if self.config["file_path"]:
             try:
-                product_json = self.get_dataset()
-                if isinstance(product_json, list) and isinstance(response_json, list):
-                    key = find_id_property(response_json[0])
-                    if key:
+                index = await load_dataset_index(self.get_dataset_name(), self.get_dataset)
+                if index is not None and isinstance(response_json, list) and len(response_json) > 0:
+                    if not validated:
+                        key = find_id_property(response_json[0]) if isinstance(response_json[0], dict) else None
                         for resp in response_json:
-                            has_id = any(p[key] == resp[key] for p in product_json)
-                            if has_id:
-                                resp["exists"] = True
-                                logger.debug('exists {}', json.dumps(resp))
-                            else:
-                                resp["exists"] = False
-                                logger.warning(f'no such key {key} in {json.dumps(resp)}')
-                    tracker[config_id]["results"] = response_json
+                            self.check_item(index, resp, key)
+                    result["results"] = response_json
 
             except Exception as e:
                 logger.error("Could not validate from dataset: {}", str(e))
 
-        with open(self.results_path, 'w') as file:
-            json.dump(tracker, file)
+        self.results.put(self.test_id, self.get_config_id(), self.repeat, result)
+
+    def check_item(self, index, resp, key):
+        """
+        Marks whether a response item `exists` in the dataset by its id, or what else it matched by. True if it exists.
+        Answers without an id property (e.g. themes with only a title and description) aren't dataset items, so
+        they aren't checked; the title and fuzzy fallbacks only apply to items whose id doesn't resolve.
+        """
+        if not isinstance(resp, dict) or not key:
+            return False
+        record, matched_by = index.find(resp, key)
+        resp["exists"] = matched_by == 'id'
+        if matched_by == 'id':
+            logger.debug('exists {}', json.dumps(resp))
+        elif record is not None:
+            # wrong or missing id, but the item is recognisable by its title
+            resp["matched_by"] = matched_by
+            resp["matched_id"] = record.get(index.id_key)
+            logger.warning(f'no such key {key} in {json.dumps(resp)}, matched by {matched_by}')
+        else:
+            logger.warning(f'no such key {key} in {json.dumps(resp)}')
+        return resp["exists"]
 
     def get_config_id(self):
         id_parts = []
@@ -375,33 +580,143 @@ class Prompter:
             id_parts.append('assistant')
         if self.config["code_interpreter"]:
             id_parts.append('code')
+        if self.config.get("chunking"):
+            id_parts.append('chunked')
+        if self.config.get("static_first"):
+            id_parts.append('static')
+        if self.config.get("per_question"):
+            id_parts.append('questions')
+        if self.config.get("field_weights"):
+            id_parts.append('weighted')
+        if self.config.get("top_n"):
+            id_parts.append(f"top{int(self.config['top_n'])}")
         return '-'.join(id_parts)
 
 
-class EventHandler(AssistantEventHandler):
-    def __init__(self):
+async def run_embeddings_batch(prompters):
+    """
+    Runs Embeddings cells that share a catalogue together: the catalogue is loaded once, every survey is
+    embedded in batched calls and scored with one matrix product, then each cell writes its own result.
+    """
+    file_path = prompters[0].config["file_path"]
+    if ".emb" not in file_path and ".pkl" not in file_path:
+        return logger.critical("\nFirst build your embeddings! `python indexer.py build_embeddings <data_file>`\n")
+
+    started = datetime.datetime.now()
+    surveys = [prompter.embedding_input() for prompter in prompters]
+    weights = [prompter.config.get("field_weights") or None for prompter in prompters]
+    # search once for the largest Top N in the batch, then cut each cell's answer to its own
+    top_ns = [int(prompter.config.get("top_n") or 5) for prompter in prompters]
+    # Embeddings uses the blocking client and numpy, so keep it off the event loop
+    embeddings = await asyncio.to_thread(prompters[0].datasets.embeddings, file_path, get_openai())
+    responses = await asyncio.to_thread(embeddings.find_recommendations_batch, surveys, max(top_ns), None, weights)
+    ended = datetime.datetime.now()
+
+    for prompter, response_json, top_n in zip(prompters, responses, top_ns):
+        if response_json is not None:
+            response_json = response_json[:top_n]
+        prompter.started, prompter.ended = started, ended
+        if len(prompters) > 1:
+            prompter.batch_size = len(prompters)
+        logger.debug("\n\nEMBEDDING RESULT: {}\n", json.dumps(response_json))
+        await prompter.validate_response(response_json, response_json)
+
+
+def prefix_key(prompt, config):
+    """
+    Cells with the same key open with the same prompt prefix (model, dataset and instructions as written).
+    """
+    return config["model"], config["file_path"] or '', prompt["instruction"]
+
+
+def is_scored(item):
+    return isinstance(item, dict) and isinstance(item.get('score'), (int, float)) and not isinstance(item['score'], bool) \
+        and item['score'] == item['score']  # not NaN
+
+
+def merge_chunk_results(results, top_n=None):
+    """
+    Merges the JSON answers of each chunk, best first for the items that carry a numeric score. Items
+    repeated across chunks (by their id property, or whole) are kept once, and the answer is cut to
+    `top_n`, or else to the length of the longest chunk answer, since each chunk was asked the full question.
+    """
+    merged = []
+    longest = 0
+    for result in results:
+        if isinstance(result, list):
+            merged.extend(result)
+            longest = max(longest, len(result))
+        elif isinstance(result, dict):
+            merged.append(result)
+            longest = max(longest, 1)
+    if len(merged) == 0:
+        return None
+    # scored items best first, then the unscored ones in the order they came
+    merged.sort(key=lambda item: -item['score'] if is_scored(item) else float('inf'))
+
+    seen = set()
+    unique = []
+    for item in merged:
+        key = find_id_property(item) if isinstance(item, dict) else None
+        identity = ('id', normalize_id(item[key])) if key and item.get(key) is not None else json.dumps(item, sort_keys=True)
+        if identity not in seen:
+            seen.add(identity)
+            unique.append(item)
+    return unique[:int(top_n) if top_n else longest]
+
+
+def vector_store_is_active(vector):
+    if vector.status == 'expired':
+        return False
+    return vector.expires_at is None or int(datetime.datetime.now().timestamp()) < vector.expires_at
+
+
+class EventHandler(AsyncAssistantEventHandler):
+    """
+    Collects a streamed Thread run. Deltas go into a list that is joined once, and text and tool calls are
+    logged when they are done rather than per delta, so a long response stays linear and quiet. Each item
+    of a JSON array answer is passed to `on_item` as soon as it's complete.
+    """
+
+    def __init__(self, on_item=None):
         super().__init__()
-        self._response = ''
+        self._deltas = []
+        self.stream = JsonArrayStream()
+        self.on_item = on_item
+        self.stream_started = time.monotonic()
+        self.first_token = None
+        self.stream_ended = None
 
     def response(self):
-        return self._response
-
-    def on_text_created(self, text) -> None:
-        logger.opt(raw=True).debug(f"\nassistant > ")
-
-    def on_text_delta(self, delta, snapshot):
-        logger.opt(raw=True).debug(delta.value)
-        self._response += delta.value
-
-    def on_tool_call_created(self, tool_call):
+        return ''.join(self._deltas)
+
+    def timings(self):
+        ended = self.stream_ended or time.monotonic()
+        timings = {}
+        if self.first_token is not None:
+            timings["ttft"] = round(self.first_token - self.stream_started, 3)
+        timings["stream_time"] = round(ended - self.stream_started, 3)
+        return timings
+
+    async def on_text_delta(self, delta, snapshot):
+        if self.first_token is None:
+            self.first_token = time.monotonic()
+        if delta.value:
+            self._deltas.append(delta.value)
+            for item in self.stream.feed(delta.value):
+                if self.on_item is not None:
+                    self.on_item(item)
+
+    async def on_text_done(self, text) -> None:
+        logger.opt(raw=True).debug(f"\nassistant > {text.value}\n")
+
+    async def on_tool_call_done(self, tool_call):
         logger.opt(raw=True).debug(f"\nassistant > {tool_call.type}\n")
-
-    def on_tool_call_delta(self, delta, snapshot):
-        if delta.type == 'code_interpreter':
-            if delta.code_interpreter.input:
-                logger.opt(raw=True).debug(delta.code_interpreter.input)
-            if delta.code_interpreter.outputs:
-                logger.opt(raw=True).debug(f"\n\noutput >")
-                for output in delta.code_interpreter.outputs:
-                    if output.type == "logs":
-                        logger.opt(raw=True).debug(f"\n{output.logs}")
+        if tool_call.type == 'code_interpreter':
+            logger.opt(raw=True).debug(tool_call.code_interpreter.input)
+            for output in tool_call.code_interpreter.outputs or []:
+                if output.type == "logs":
+                    logger.opt(raw=True).debug(f"\n\noutput >\n{output.logs}")
+
+    async def on_end(self):
+        self.stream_ended = time.monotonic()
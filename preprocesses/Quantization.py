@@ -0,0 +1,189 @@
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+KINDS = ['float16', 'int8', 'pq']
+CHUNK_ROWS = 8192  # rows decoded at once while scoring, to bound memory
+
+
+def quant_path(store_file):
+    return store_file + '.quant.npz'
+
+
+def truncate_blocks(matrix, fields, dim, dims):
+    """
+    Keeps the first `dims` dimensions of every field block and re-normalizes each block (Matryoshka truncation).
+    """
+    blocks = np.asarray(matrix, dtype=np.float32).reshape(matrix.shape[0], fields, dim)[:, :, :dims]
+    norms = np.linalg.norm(blocks, axis=2, keepdims=True)
+    norms[norms == 0] = 1
+    return (blocks / norms).reshape(matrix.shape[0], fields * dims)
+
+
+def train_codebooks(data, subspaces, k, iterations=10, seed=0):
+    """
+    Plain k-means in each of the `subspaces` slices of `data`, for product quantization.
+    """
+    rng = np.random.default_rng(seed)
+    sub = data.shape[1] // subspaces
+    k = min(k, data.shape[0])
+    codebooks = np.empty((subspaces, k, sub), dtype=np.float32)
+    for j in range(subspaces):
+        points = data[:, j * sub:(j + 1) * sub]
+        centroids = points[rng.choice(len(points), k, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(points @ centroids.T - 0.5 * (centroids ** 2).sum(axis=1), axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, points)
+            counts = np.bincount(assignments, minlength=k)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+        codebooks[j] = centroids
+    return codebooks
+
+
+class Quantized:
+    """
+    A compressed copy of an EmbeddingStore matrix that is held in memory and scored directly, while the
+    float32 store stays memory-mapped on disk for re-ranking the top candidates exactly.
+
+    `float16` halves the matrix, `int8` stores each column scaled to [-127, 127] (a quarter), and `pq`
+    product-quantizes rows into one byte per subspace of `PQ_SUB_DIMS` dimensions. Any of them can first
+    truncate each field to its leading `dims` dimensions, which text-embedding-3 models support.
+    """
+
+    def __init__(self, kind, codes, rows, fields, dims, scale=None, codebooks=None):
+        self.kind = kind
+        self.codes = codes
+        self.rows = int(rows)
+        self.fields = int(fields)
+        self.dims = int(dims)
+        self.scale = scale
+        self.codebooks = codebooks
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in [self.codes, self.scale, self.codebooks] if array is not None)
+
+    @classmethod
+    def build(cls, store, kind='int8', dims=None, sample=65536, seed=0):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown quantization {kind}, use one of {', '.join(KINDS)}")
+        fields = len(store.fields)
+        dims = min(int(dims or store.dim), store.dim)
+        rows = store.matrix.shape[0]
+
+        def chunks():
+            for start in range(0, rows, CHUNK_ROWS):
+                yield truncate_blocks(store.matrix[start:start + CHUNK_ROWS], fields, store.dim, dims)
+
+        if kind == 'float16':
+            codes = np.concatenate([chunk.astype(np.float16) for chunk in chunks()]) if rows else np.zeros((0, fields * dims), np.float16)
+            return cls(kind, codes, rows, fields, dims)
+
+        if kind == 'int8':
+            peak = np.zeros(fields * dims, dtype=np.float32)
+            for chunk in chunks():
+                peak = np.maximum(peak, np.abs(chunk).max(axis=0))
+            scale = np.where(peak > 0, peak / 127, 1).astype(np.float32)
+            codes = np.concatenate([np.round(chunk / scale).astype(np.int8) for chunk in chunks()]) if rows else np.zeros((0, fields * dims), np.int8)
+            return cls(kind, codes, rows, fields, dims, scale=scale)
+
+        sub_dims = int(os.getenv("PQ_SUB_DIMS", 8))
+        if (fields * dims) % sub_dims != 0:
+            raise ValueError(f"PQ_SUB_DIMS ({sub_dims}) must divide the row width ({fields * dims})")
+        subspaces = fields * dims // sub_dims
+        rng = np.random.default_rng(seed)
+        picks = np.sort(rng.choice(rows, min(rows, sample), replace=False))
+        codebooks = train_codebooks(truncate_blocks(store.matrix[picks], fields, store.dim, dims), subspaces, 256, seed=seed)
+        codes = np.empty((rows, subspaces), dtype=np.uint8)
+        for start, chunk in zip(range(0, rows, CHUNK_ROWS), chunks()):
+            parts = chunk.reshape(len(chunk), subspaces, sub_dims)
+            for j in range(subspaces):
+                codes[start:start + len(chunk), j] = np.argmax(
+                    parts[:, j] @ codebooks[j].T - 0.5 * (codebooks[j] ** 2).sum(axis=1), axis=1)
+        return cls(kind, codes, rows, fields, dims, codebooks=codebooks)
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        arrays = {"codes": self.codes}
+        if self.scale is not None:
+            arrays["scale"] = self.scale
+        if self.codebooks is not None:
+            arrays["codebooks"] = self.codebooks
+        np.savez(tmp_path, kind=self.kind, rows=self.rows, fields=self.fields, dims=self.dims, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(str(data["kind"]), data["codes"], data["rows"], data["fields"], data["dims"],
+                       data["scale"] if "scale" in data else None, data["codebooks"] if "codebooks" in data else None)
+
+    def truncate_queries(self, queries):
+        # (m, fields * dim) query rows from EmbeddingStore.query_matrix, cut to the stored dimensions with
+        # each block keeping its norm, which is its field weight
+        blocks = queries.reshape(len(queries), self.fields, -1)
+        truncated = blocks[:, :, :self.dims]
+        norms = np.linalg.norm(truncated, axis=2, keepdims=True)
+        norms[norms == 0] = 1
+        truncated = truncated * (np.linalg.norm(blocks, axis=2, keepdims=True) / norms)
+        return truncated.reshape(len(queries), -1)
+
+    def scores(self, queries, rows=None):
+        """
+        Returns an (n, m) matrix of approximate scores for all rows, or only the given row indices.
+        """
+        queries = self.truncate_queries(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        codes = self.codes if rows is None else self.codes[rows]
+        scores = np.empty((len(codes), len(queries)), dtype=np.float32)
+
+        if self.kind == 'pq':
+            sub_dims = queries.shape[1] // self.codes.shape[1]
+            tables = np.einsum('qms,mks->qmk', queries.reshape(len(queries), -1, sub_dims), self.codebooks)
+            subspaces = np.arange(self.codes.shape[1])
+            for start in range(0, len(codes), CHUNK_ROWS):
+                chunk = codes[start:start + CHUNK_ROWS]
+                for i in range(len(queries)):
+                    scores[start:start + len(chunk), i] = tables[i][subspaces, chunk].sum(axis=1)
+            return scores
+
+        weights = queries * self.scale if self.kind == 'int8' else queries
+        for start in range(0, len(codes), CHUNK_ROWS):
+            scores[start:start + CHUNK_ROWS] = codes[start:start + CHUNK_ROWS].astype(np.float32) @ weights.T
+        return scores
+
+
+def quantization_report(store, k=10, queries=100, dims_options=None, rerank=4, seed=0):
+    """
+    Memory and recall@k of each quantization (and Matryoshka truncation) against exact float32 search,
+    with and without re-ranking `rerank * k` candidates exactly. Uses catalogue rows as queries.
+    """
+    alive = [i for i in range(store.matrix.shape[0]) if i not in store.deleted]
+    if len(alive) == 0:
+        return []
+    rng = np.random.default_rng(seed)
+    picks = np.sort(rng.choice(alive, min(queries, len(alive)), replace=False))
+    vectors = np.asarray(store.matrix[picks], dtype=np.float32).reshape(len(picks), len(store.fields), store.dim).sum(axis=1)
+    exact = store.search(vectors, k, exact=True)
+
+    report = [{"kind": "float32", "dims": store.dim, "mb": round(store.matrix.nbytes / 1024 / 1024, 1),
+               "recall": 1.0, "recall_reranked": 1.0}]
+    previous = store.quantized, store.index
+    store.index = None  # compare the codes alone, not the IVF index
+    try:
+        for dims in [None] + [dims for dims in dims_options or [] if dims < store.dim]:
+            for kind in KINDS:
+                store.quantized = Quantized.build(store, kind, dims)
+                recall = {}
+                for factor in [1, rerank]:
+                    found = store.search(vectors, k, exact=False, rerank=factor)
+                    recall[factor] = sum(len(set(e.tolist()) & set(f.tolist())) for e, f in zip(exact, found)) / max(1, sum(len(e) for e in exact))
+                report.append({"kind": kind, "dims": store.quantized.dims, "mb": round(store.quantized.nbytes / 1024 / 1024, 1),
+                               "recall": round(recall[1], 3), "recall_reranked": round(recall[rerank], 3)})
+    finally:
+        store.quantized, store.index = previous
+    return report
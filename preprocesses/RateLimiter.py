@@ -0,0 +1,185 @@
+import asyncio
+import os
+import random
+import re
+import threading
+import time
+
+import openai
+from dotenv import load_dotenv
+from loguru import logger
+
+load_dotenv()
+
+
+def parse_reset(value):
+    """
+    Parses OpenAI's reset durations like `1s`, `6m0s` or `20ms` into seconds.
+    """
+    if value is None:
+        return None
+    seconds = 0.0
+    for amount, unit in re.findall(r'([\d.]+)(ms|h|m|s)', str(value)):
+        seconds += float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return seconds
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """
+        Takes `amount` from the bucket and returns how long the caller must wait before it is covered.
+        The level may go negative, which queues later callers behind this one.
+        """
+        self.refill(now)
+        amount = min(amount, self.capacity)  # a single oversized request still has to go through eventually
+        self.level -= amount
+        if self.level >= 0:
+            return 0
+        return -self.level * 60 / self.capacity
+
+    def sync(self, limit=None, remaining=None, now=None):
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.refill(now)
+            self.level = min(self.level, float(remaining))
+
+
+class RateLimiter:
+    """
+    Shared requests-per-minute and tokens-per-minute buckets for every OpenAI call in the process.
+
+    Buckets are keyed by model (or by endpoint for file / vector store calls), start from
+    RATE_LIMIT_RPM / RATE_LIMIT_TPM and are corrected from the x-ratelimit-* response headers.
+    Bookkeeping is behind a threading lock so async cells and the Embeddings worker threads share it.
+    """
+
+    def __init__(self, rpm=None, tpm=None, max_retries=None):
+        self.rpm = int(rpm or os.getenv("RATE_LIMIT_RPM", 500))
+        self.tpm = int(tpm or os.getenv("RATE_LIMIT_TPM", 200000))
+        self.max_retries = int(max_retries if max_retries is not None else os.getenv("RATE_LIMIT_RETRIES", 6))
+        self.requests = {}
+        self.tokens = {}
+        self.paused_until = {}
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "throttled": 0, "retries": 0, "waited": 0.0}
+
+    def buckets(self, model):
+        if model not in self.requests:
+            self.requests[model] = TokenBucket(self.rpm)
+            self.tokens[model] = TokenBucket(self.tpm)
+        return self.requests[model], self.tokens[model]
+
+    def reserve(self, model, tokens=0):
+        with self.lock:
+            now = time.monotonic()
+            requests, token_bucket = self.buckets(model)
+            wait = max(requests.reserve(1, now), token_bucket.reserve(tokens, now) if tokens else 0,
+                       self.paused_until.get(model, 0) - now)
+            self.stats["requests"] += 1
+            if wait > 0:
+                self.stats["throttled"] += 1
+                self.stats["waited"] += wait
+            return wait
+
+    async def acquire(self, model, tokens=0):
+        wait = self.reserve(model, tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, model, tokens=0):
+        wait = self.reserve(model, tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def update_from_headers(self, model, headers):
+        if headers is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            requests, token_bucket = self.buckets(model)
+            requests.sync(headers.get('x-ratelimit-limit-requests'), headers.get('x-ratelimit-remaining-requests'), now)
+            token_bucket.sync(headers.get('x-ratelimit-limit-tokens'), headers.get('x-ratelimit-remaining-tokens'), now)
+
+    def backoff(self, model, attempt, error):
+        """
+        Returns a jittered delay for a failed attempt and pauses the model's bucket for every caller.
+        """
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+        self.update_from_headers(model, headers)
+        delay = min(60.0, 2 ** attempt) * random.uniform(0.5, 1.0)
+        retry_after = headers.get('retry-after')
+        if retry_after is not None:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        reset = max(parse_reset(headers.get('x-ratelimit-reset-requests')) or 0,
+                    parse_reset(headers.get('x-ratelimit-reset-tokens')) or 0)
+        delay = max(delay, reset) + random.uniform(0, 0.5)
+        with self.lock:
+            self.paused_until[model] = max(self.paused_until.get(model, 0), time.monotonic() + delay)
+            self.stats["retries"] += 1
+        return delay
+
+    def should_retry(self, error, attempt):
+        if attempt >= self.max_retries:
+            return False
+        if isinstance(error, openai.RateLimitError):
+            # an empty account won't recover by waiting
+            return getattr(error, 'code', None) != 'insufficient_quota'
+        return isinstance(error, (openai.APIConnectionError, openai.InternalServerError))
+
+    def unwrap(self, model, response):
+        # `with_raw_response` calls hand back the headers, which keep the buckets honest
+        if hasattr(response, 'headers') and hasattr(response, 'parse'):
+            self.update_from_headers(model, response.headers)
+            return response.parse()
+        return response
+
+    async def call(self, model, tokens, fn, /, *args, **kwargs):
+        attempt = 0
+        while True:
+            await self.acquire(model, tokens)
+            try:
+                return self.unwrap(model, await fn(*args, **kwargs))
+            except Exception as e:
+                if not self.should_retry(e, attempt):
+                    raise
+                delay = self.backoff(model, attempt, e)
+                logger.warning(f"{model} rate limited, retrying in {delay:.1f}s ({e.__class__.__name__})")
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    def call_sync(self, model, tokens, fn, /, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire_sync(model, tokens)
+            try:
+                return self.unwrap(model, fn(*args, **kwargs))
+            except Exception as e:
+                if not self.should_retry(e, attempt):
+                    raise
+                delay = self.backoff(model, attempt, e)
+                logger.warning(f"{model} rate limited, retrying in {delay:.1f}s ({e.__class__.__name__})")
+                attempt += 1
+                time.sleep(delay)
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter()
+    return _rate_limiter
@@ -0,0 +1,291 @@
+import gzip
+import json
+import os
+import re
+
+from dotenv import load_dotenv
+
+from .Utils import adler32
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+load_dotenv()
+
+STATE_VERSION = 2
+COMPACT_RATIO = 0.25  # rewrite the row log once this share of its lines are superseded
+MAX_SUMMARY_VALUES = 20  # columns with more distinct values only report their count
+MANIFEST_VERSION = 1
+
+
+def shard_file(shard):
+    prompt_id = json.loads(shard)
+    slug = re.sub(r'[^0-9A-Za-z_-]+', '-', str(prompt_id))[:40] if prompt_id is not None else 'none'
+    return f"{slug}-{adler32(shard)}.json"
+
+
+def summarize(rows):
+    """
+    Per-column summaries for the grid: how many rows have a value, the range of numeric columns and
+    the distinct values of short scalar columns.
+    """
+    columns = {}
+    for row in rows:
+        for key, value in row.items():
+            column = columns.setdefault(key, {"count": 0, "values": []})
+            if value is None:
+                continue
+            column["count"] += 1
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                column["min"] = min(column.get("min", value), value)
+                column["max"] = max(column.get("max", value), value)
+                column["values"] = None  # numbers report their range instead
+            elif isinstance(value, (str, bool)) and len(str(value)) <= 64:
+                if column["values"] is not None and value not in column["values"]:
+                    column["values"].append(value)
+                    if len(column["values"]) > MAX_SUMMARY_VALUES:
+                        column["values"] = None
+            else:
+                column["values"] = None
+    return columns
+
+
+def merge_summaries(summaries):
+    merged = {}
+    for columns in summaries:
+        for key, column in columns.items():
+            if key not in merged:
+                merged[key] = {"count": 0, "values": []}
+            target = merged[key]
+            target["count"] += column["count"]
+            for bound, pick in (("min", min), ("max", max)):
+                if bound in column:
+                    target[bound] = pick(target.get(bound, column[bound]), column[bound])
+            if target["values"] is None or column["values"] is None:
+                target["values"] = None
+            else:
+                target["values"] += [value for value in column["values"] if value not in target["values"]]
+                if len(target["values"]) > MAX_SUMMARY_VALUES:
+                    target["values"] = None
+    return merged
+
+
+def compressions():
+    encodings = [encoding.strip() for encoding in os.getenv("RESULTS_COMPRESS", "").split(',') if encoding.strip()]
+    if 'br' in encodings and brotli is None:
+        print('RESULTS_COMPRESS includes br but the `brotli` package is not installed, skipping brotli shards')
+        encodings.remove('br')
+    return encodings
+
+
+def write_compressed(path, data, encodings):
+    for encoding in ['gzip', 'br']:
+        suffix = '.gz' if encoding == 'gzip' else '.br'
+        if encoding not in encodings:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+            continue
+        compressed = gzip.compress(data, compresslevel=9, mtime=0) if encoding == 'gzip' else brotli.compress(data)
+        with open(path + suffix, 'wb') as f:
+            f.write(compressed)
+
+
+class ResultsIndex:
+    """
+    The state of an incrementally built results index: which result files (by mtime and size) and which
+    results store rows (by write sequence) were already indexed, the merged column definitions, and a
+    `rows.jsonl` log of indexed rows.
+
+    Each log line is `<key>\t<shard>\t<row>`, keyed by [filename, runkey] and sharded by prompt_id. A
+    re-indexed row is appended again and the last line for a key wins, a null row removes it, so an
+    update only appends the rows that changed and only rewrites the shards those rows belong to.
+    """
+
+    def __init__(self, source_dir, path=None):
+        base = path or os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                                    os.getenv("RESULTS_INDEX_STATE", ".cache/results-index")))
+        self.dir = os.path.join(base, str(adler32(source_dir)))  # one state per RESULTS_DIR
+        self.state_path = os.path.join(self.dir, 'state.json')
+        self.rows_path = os.path.join(self.dir, 'rows.jsonl')
+        self.state = None
+        self.added = 0
+        self.load()
+
+    def empty(self):
+        return {"version": STATE_VERSION, "store_seq": 0, "files": {}, "columns": {}, "lines": 0, "written_lines": 0,
+                "shards": {}}
+
+    def load(self):
+        self.state = self.empty()
+        if os.path.exists(self.state_path) and os.path.exists(self.rows_path):
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+            if state.get("version") == STATE_VERSION:
+                self.state = state
+                return
+        self.reset()  # no state, or an older log format: start over
+
+    def reset(self):
+        self.state = self.empty()
+        if os.path.exists(self.rows_path):
+            os.remove(self.rows_path)
+
+    def save(self):
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def file_changed(self, filename, signature):
+        entry = self.state["files"].get(filename)
+        return entry is None or entry["signature"] != list(signature)
+
+    def changed_files(self, directory, filenames):
+        """
+        Returns the result files that are new or changed since they were indexed, and drops the rows of deleted ones.
+        """
+        changed = []
+        for filename in filenames:
+            stat = os.stat(os.path.join(directory, filename))
+            if self.file_changed(filename, (stat.st_mtime_ns, stat.st_size)):
+                changed.append((filename, (stat.st_mtime_ns, stat.st_size)))
+        for filename in set(self.state["files"]) - set(filenames):
+            self.append([([filename, runkey], None, None) for runkey in self.state["files"].pop(filename)["runs"]])
+        return changed
+
+    def index_file(self, filename, signature, rows):
+        """
+        Records the rows of a changed result file, removing the runs it no longer has.
+        """
+        previous = self.state["files"].get(filename, {}).get("runs", [])
+        runs = [runkey for runkey, _ in rows]
+        self.append([([filename, runkey], None, None) for runkey in previous if runkey not in runs] +
+                    [([filename, runkey], row.get('prompt_id'), row) for runkey, row in rows])
+        self.state["files"][filename] = {"signature": list(signature), "runs": runs}
+
+    def append(self, rows):
+        if len(rows) == 0:
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        with open(self.rows_path, 'a', encoding='utf-8') as f:
+            for key, prompt_id, row in rows:
+                # tombstones leave the shard empty, the key's previous line says which shard it left
+                shard = json.dumps(prompt_id) if row is not None else ''
+                f.write(json.dumps(key) + '\t' + shard + '\t' + json.dumps(row) + '\n')
+        self.state["lines"] += len(rows)
+        self.added += sum(1 for _, _, row in rows if row is not None)
+
+    def scan(self):
+        """
+        One pass over the log. Returns {line number: shard} for the current row of each key, and the
+        shards with lines written since the last write().
+        """
+        last = {}
+        dirty = set()
+        if os.path.exists(self.rows_path):
+            with open(self.rows_path, 'r', encoding='utf-8') as f:
+                for number, line in enumerate(f):
+                    key, shard, row = line.split('\t', 2)
+                    if number >= self.state["written_lines"]:
+                        dirty.add(shard)
+                        if key in last:
+                            dirty.add(last[key][1])
+                    last[key] = (number if row.strip() != 'null' else None, shard)
+        dirty.discard('')
+        return {number: shard for number, shard in last.values() if number is not None}, dirty
+
+    def lines(self, numbers):
+        if not os.path.exists(self.rows_path):
+            return
+        with open(self.rows_path, 'r', encoding='utf-8') as f:
+            for number, line in enumerate(f):
+                if number in numbers:
+                    key, shard, row = line.split('\t', 2)
+                    yield shard, row.rstrip('\n')
+
+    def rows(self):
+        """
+        Yields the current rows as JSON strings.
+        """
+        live, _ = self.scan()
+        for shard, row in self.lines(live):
+            yield row
+
+    def write(self, output_path, shard_dir=None):
+        """
+        Streams the current rows into a JSON array at `output_path` without parsing them, and rewrites the
+        shards of `shard_dir` that changed. Returns the row count.
+        """
+        live, dirty = self.scan()
+        tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            out.write('[')
+            first = True
+            for shard, row in self.lines(live):
+                out.write(('\n' if first else ',\n') + row)
+                first = False
+            out.write('\n]')
+        os.replace(tmp_path, output_path)
+
+        if shard_dir is not None:
+            if not os.path.exists(os.path.join(shard_dir, 'manifest.json')):
+                dirty = set(live.values()) | set(self.state["shards"].keys())
+            self.write_shards(shard_dir, live, dirty)
+
+        if self.state["lines"] > 0 and len(live) < self.state["lines"] * (1 - COMPACT_RATIO):
+            self.compact(live)
+        self.state["written_lines"] = self.state["lines"]
+        return len(live)
+
+    def write_shards(self, shard_dir, live, dirty):
+        """
+        Writes one JSON array per prompt_id for the changed shards (plus .gz / .br copies for servers that
+        serve pre-compressed files), and a manifest listing every shard with per-column summaries.
+        """
+        os.makedirs(shard_dir, exist_ok=True)
+        encodings = compressions()
+        rows = {shard: [] for shard in dirty}
+        for shard, row in self.lines({number for number, shard in live.items() if shard in dirty}):
+            rows[shard].append(row)
+
+        for shard, shard_rows in rows.items():
+            path = os.path.join(shard_dir, shard_file(shard))
+            if len(shard_rows) == 0:
+                self.state["shards"].pop(shard, None)
+                for suffix in ['', '.gz', '.br']:
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+                continue
+            data = ('[\n' + ',\n'.join(shard_rows) + '\n]').encode('utf-8')
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            write_compressed(path, data, encodings)
+            self.state["shards"][shard] = {"file": shard_file(shard), "rows": len(shard_rows), "bytes": len(data),
+                                           "columns": summarize(json.loads(row) for row in shard_rows)}
+
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "rows": sum(shard["rows"] for shard in self.state["shards"].values()),
+            "encodings": encodings,
+            "shards": [{"prompt_id": json.loads(shard), "file": entry["file"], "rows": entry["rows"], "bytes": entry["bytes"]}
+                       for shard, entry in sorted(self.state["shards"].items())],
+            "columns": merge_summaries(entry["columns"] for entry in self.state["shards"].values()),
+        }
+        tmp_path = os.path.join(shard_dir, f"manifest.json.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(shard_dir, 'manifest.json'))
+
+    def compact(self, live):
+        tmp_path = f"{self.rows_path}.{os.getpid()}.tmp"
+        with open(self.rows_path, 'r', encoding='utf-8') as f, open(tmp_path, 'w', encoding='utf-8') as out:
+            for number, line in enumerate(f):
+                if number in live:
+                    out.write(line)
+        os.replace(tmp_path, self.rows_path)
+        self.state["lines"] = len(live)
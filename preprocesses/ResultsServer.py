@@ -0,0 +1,168 @@
+import json
+import os
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from dotenv import load_dotenv
+
+from .ResultsIndex import ResultsIndex
+from .ResultsStore import results_dir
+
+load_dotenv()
+
+MAX_PAGE_SIZE = 500
+# the columns the API can filter, sort and group by; anything else is rejected rather than put in SQL
+FILTERS = ['prompt_id', 'model', 'executable', 'file_path', 'survey_id', 'runkey', 'filename', 'repeat']
+SORTS = FILTERS + ['id', 'ms', 'started', 'ended', 'items', 'exists_count']
+
+
+def text_of(value):
+    """
+    The searchable text of a result: every string inside it, so matches aren't on JSON syntax.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return ' '.join(text_of(item) for item in value.values())
+    if isinstance(value, list):
+        return ' '.join(text_of(item) for item in value)
+    return ''
+
+
+class ResultsQuery:
+    """
+    The indexed results loaded into an in-memory SQLite database: one row per run with the columns the
+    API filters and groups on, the whole row as JSON, and an FTS5 table over prompt, instructions and results.
+    """
+
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("""CREATE TABLE runs (
+            id INTEGER PRIMARY KEY,
+            filename TEXT, runkey TEXT, prompt_id TEXT, model TEXT, executable TEXT, file_path TEXT,
+            survey_id TEXT, repeat INTEGER, ms REAL, started TEXT, ended TEXT, error TEXT,
+            items INTEGER, exists_count INTEGER, row TEXT)""")
+        self.db.execute("CREATE VIRTUAL TABLE runs_fts USING fts5(prompt, instructions, results, content='')")
+
+    def load(self, rows):
+        records, texts = [], []
+        for i, row in enumerate(rows):
+            config = row.get('config') or {}
+            results = row.get('results')
+            items = [item for item in results if isinstance(item, dict)] if isinstance(results, list) else []
+            records.append((i, row.get('filename'), row.get('runkey'), none_or_str(row.get('prompt_id')), row.get('model'),
+                            config.get('executable'), config.get('file_path'), none_or_str(row.get('survey_id')),
+                            row.get('repeat', 0), row.get('ms'), row.get('started'), row.get('ended'), row.get('error'),
+                            len(items), sum(1 for item in items if item.get('exists') is True), json.dumps(row)))
+            texts.append((i, text_of(row.get('prompt')), text_of(row.get('instructions')), text_of(results)))
+        with self.lock:
+            self.db.executemany(f"INSERT INTO runs VALUES ({','.join('?' * 16)})", records)
+            self.db.executemany("INSERT INTO runs_fts (rowid, prompt, instructions, results) VALUES (?, ?, ?, ?)", texts)
+            for column in ['prompt_id', 'model', 'executable', 'survey_id']:
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS runs_{column} ON runs ({column})")
+            self.db.commit()
+        return len(records)
+
+    def where(self, params):
+        clauses, args = [], []
+        for column in FILTERS:
+            if column in params:
+                clauses.append(f"{column} = ?")
+                args.append(params[column])
+        if params.get('q'):
+            clauses.append("id IN (SELECT rowid FROM runs_fts WHERE runs_fts MATCH ?)")
+            args.append(params['q'])
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', args
+
+    def results(self, params):
+        sort = params.get('sort', 'id')
+        if sort not in SORTS:
+            raise ValueError(f"Can't sort by {sort}")
+        order = 'DESC' if params.get('order', 'asc').lower() == 'desc' else 'ASC'
+        per_page = min(MAX_PAGE_SIZE, max(1, int(params.get('per_page', 50))))
+        page = max(1, int(params.get('page', 1)))
+
+        where, args = self.where(params)
+        with self.lock:
+            total = self.db.execute(f"SELECT COUNT(*) FROM runs{where}", args).fetchone()[0]
+            rows = self.db.execute(f"SELECT row FROM runs{where} ORDER BY {sort} {order}, id LIMIT ? OFFSET ?",
+                                   args + [per_page, (page - 1) * per_page]).fetchall()
+        return {"total": total, "page": page, "per_page": per_page, "rows": [json.loads(row[0]) for row in rows]}
+
+    def group_by(self, params, default):
+        columns = [column for column in params.get('by', default).split(',') if column]
+        for column in columns:
+            if column not in FILTERS:
+                raise ValueError(f"Can't group by {column}")
+        return columns
+
+    def aggregate(self, select, params, default):
+        columns = self.group_by(params, default)
+        where, args = self.where(params)
+        group = ', '.join(columns)
+        with self.lock:
+            cursor = self.db.execute(f"SELECT {group}, {select} FROM runs{where} GROUP BY {group} ORDER BY {group}", args)
+            names = [description[0] for description in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def mean_ms(self, params):
+        return self.aggregate("COUNT(*) AS runs, AVG(ms) AS mean_ms, MIN(ms) AS min_ms, MAX(ms) AS max_ms",
+                              params, 'model,executable')
+
+    def exists_rate(self, params):
+        return self.aggregate("COUNT(*) AS runs, SUM(items) AS items, SUM(exists_count) AS exists_count, "
+                              "CAST(SUM(exists_count) AS REAL) / MAX(1, SUM(items)) AS exists_rate",
+                              params, 'prompt_id')
+
+
+def none_or_str(value):
+    return None if value is None else str(value)
+
+
+class ResultsHandler(BaseHTTPRequestHandler):
+    query = None
+    routes = {
+        '/results': 'results',
+        '/aggregates/ms': 'mean_ms',
+        '/aggregates/exists': 'exists_rate',
+    }
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        route = self.routes.get(url.path.rstrip('/'))
+        if route is None:
+            return self.respond(404, {"error": f"No such endpoint: {url.path}", "endpoints": list(self.routes)})
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            self.respond(200, getattr(self.query, route)(params))
+        except (ValueError, sqlite3.OperationalError) as e:
+            self.respond(400, {"error": str(e)})
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Access-Control-Allow-Origin', '*')  # the React dev server runs on another port
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve_results(host=None, port=None):
+    query = ResultsQuery()
+    count = query.load(json.loads(row) for row in ResultsIndex(results_dir()).rows())
+    host = host or os.getenv("RESULTS_SERVER_HOST", "127.0.0.1")
+    port = int(port or os.getenv("RESULTS_SERVER_PORT", 8765))
+
+    ResultsHandler.query = query
+    server = ThreadingHTTPServer((host, port), ResultsHandler)
+    print(f'Serving {count} results on http://{host}:{port} ({", ".join(ResultsHandler.routes)})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
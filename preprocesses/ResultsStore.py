@@ -0,0 +1,105 @@
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def results_dir():
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), '..', os.getenv("RESULTS_DIR")))
+
+
+def result_key(config_id, repeat=0):
+    """
+    The run key a result is listed under, matching the keys of the legacy `result-{test_id}.json` files.
+    """
+    return f"{config_id}-r{repeat}" if repeat else config_id
+
+
+class ResultsStore:
+    """
+    Every test result in one SQLite database in WAL mode, so concurrent cells (and concurrent runs)
+    each write a single row atomically instead of rewriting a whole JSON file.
+
+    Rows are keyed by (test_id, config_id, repeat) and stamped with a write sequence, so readers
+    like index_results can pick up only what was written since they last looked.
+    """
+
+    def __init__(self, path=None):
+        # outside RESULTS_DIR, which is under public/ and would be copied into the built site
+        self.path = path or os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                                         os.getenv("RESULTS_STORE", ".cache/results.sqlite")))
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if path is None:
+            self.move_legacy_store()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS results (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            test_id TEXT NOT NULL,
+            config_id TEXT NOT NULL,
+            repeat INTEGER NOT NULL,
+            written REAL NOT NULL,
+            data TEXT NOT NULL,
+            UNIQUE (test_id, config_id, repeat))""")
+        self.db.commit()
+
+    def move_legacy_store(self):
+        # stores used to default to RESULTS_DIR/results.sqlite
+        legacy = os.path.join(results_dir(), "results.sqlite")
+        if os.path.exists(legacy) and not os.path.exists(self.path):
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(legacy + suffix):
+                    shutil.move(legacy + suffix, self.path + suffix)
+            print(f'Moved {legacy} to {self.path}')
+
+    def put(self, test_id, config_id, repeat, result):
+        # a re-run replaces its row and gets a new seq, so incremental readers see it again
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO results (test_id, config_id, repeat, written, data) VALUES (?, ?, ?, ?, ?)",
+                            (test_id, config_id, repeat, time.time(), json.dumps(result)))
+            self.db.commit()
+
+    def get(self, test_id, config_id, repeat=0):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM results WHERE test_id = ? AND config_id = ? AND repeat = ?",
+                                  (test_id, config_id, repeat)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def rows(self, since=0):
+        """
+        Yields (seq, test_id, run key, result) for every row written after `since`, oldest first.
+        """
+        while True:
+            # paged, so a large store streams without holding the lock between pages
+            with self.lock:
+                rows = self.db.execute("SELECT seq, test_id, config_id, repeat, data FROM results WHERE seq > ? ORDER BY seq LIMIT 1000",
+                                       (since,)).fetchall()
+            if len(rows) == 0:
+                return
+            for seq, test_id, config_id, repeat, data in rows:
+                yield seq, test_id, result_key(config_id, repeat), json.loads(data)
+            since = rows[-1][0]
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+
+_results_store = None
+_lock = threading.Lock()
+
+
+def get_results_store():
+    global _results_store
+    with _lock:
+        if _results_store is None:
+            _results_store = ResultsStore()
+        return _results_store
@@ -0,0 +1,134 @@
+import asyncio
+import copy
+import os
+
+from dotenv import load_dotenv
+from loguru import logger
+
+from .Clients import get_async_openai, stats as connection_stats
+from .DatasetRegistry import get_registry
+from .EmbeddingCache import get_embedding_cache
+from .Prompter import Prompter, prefix_key, run_embeddings_batch
+from .RateLimiter import get_rate_limiter
+
+load_dotenv()
+
+EXECUTABLES = ['Thread', 'Completion', 'Embeddings']
+
+
+class Scheduler:
+    """
+    Runs the prompt x config x survey matrix through a bounded pool of workers.
+
+    `concurrency` caps the number of cells (and Embeddings batches) in flight overall, and each executable
+    gets its own queue and workers, up to its limit, so slow Thread runs can't starve cheap Completion or
+    Embeddings cells (or vice versa).
+    Embeddings cells against the same catalogue are run together in batches of EMBEDDINGS_BATCH_SIZE.
+    """
+
+    def __init__(self, concurrency=None, limits=None, skip_existing=False, repeat=1):
+        self.concurrency = max(1, int(concurrency or os.getenv("MAX_CONCURRENCY", 4)))
+        self.limits = {}
+        for executable in EXECUTABLES:
+            limit = (limits or {}).get(executable) or os.getenv(f"{executable.upper()}_CONCURRENCY") or self.concurrency
+            self.limits[executable] = min(self.concurrency, max(1, int(limit)))
+        self.semaphores = {}
+        self.slots = None
+        self.client = get_async_openai()
+        self.skip_existing = skip_existing
+        self.embeddings_batch = max(1, int(os.getenv("EMBEDDINGS_BATCH_SIZE", 512)))
+        self.repeat = max(1, int(repeat or 1))
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.usage = {"prompt_tokens": 0, "cached_tokens": 0}
+
+    def get_semaphore(self, executable):
+        if executable not in self.semaphores:
+            self.semaphores[executable] = asyncio.Semaphore(self.limits.get(executable, self.concurrency))
+        return self.semaphores[executable]
+
+    async def run(self, cells):
+        queues = {}
+        batches = {}
+        total = 0
+        # cells sharing a prompt prefix run back to back, while the provider still has it cached
+        for prompt, config, survey in sorted(cells, key=lambda cell: prefix_key(cell[0], cell[1])):
+            for repeat in range(self.repeat):
+                if config["executable"] == 'Embeddings' and self.embeddings_batch > 1:
+                    batches.setdefault(config["file_path"], []).append((prompt, config, survey, repeat))
+                else:
+                    queues.setdefault(config["executable"], asyncio.Queue()).put_nowait((prompt, config, survey, repeat))
+                total += 1
+
+        logger.info(f"Scheduling {total} tests with {self.concurrency} workers {self.limits}")
+        get_registry().scan()  # map uploaded filenames to local paths once, not per result
+        self.slots = asyncio.Semaphore(self.concurrency)
+        workers = [asyncio.create_task(self.worker(queue, total)) for executable, queue in queues.items()
+                   for _ in range(min(self.limits.get(executable, self.concurrency), queue.qsize()))]
+        await asyncio.gather(*[self.run_embeddings(batch, total) for batch in batches.values()])
+        for queue in queues.values():
+            await queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        logger.info(f"Finished {self.completed} tests, {self.failed} failed, {self.skipped} already answered")
+        logger.info(f"Prompt cache: {self.usage['cached_tokens']} of {self.usage['prompt_tokens']} prompt tokens cached")
+        logger.info(f"Rate limiter: {get_rate_limiter().stats}")
+        logger.info(f"Connections: {connection_stats.summary()}")
+        logger.info(f"Embedding cache: {get_embedding_cache().stats()}")
+
+    def prepare(self, prompt, config, survey, repeat):
+        """
+        Returns the cell's Prompter, or None when the cell is already answered and can be skipped.
+        """
+        # Prompter mutates its arguments, so each cell gets its own copies
+        recommender = Prompter(copy.deepcopy(prompt), copy.deepcopy(config), survey, self.client, repeat)
+        # repeats only fill in the samples that are missing
+        if (self.skip_existing or self.repeat > 1) and recommender.has_result():
+            self.skipped += 1
+            return None
+        return recommender
+
+    async def worker(self, queue, total):
+        while True:
+            prompt, config, survey, repeat = await queue.get()
+            try:
+                recommender = self.prepare(prompt, config, survey, repeat)
+                if recommender is None:
+                    continue
+                async with self.slots:
+                    await recommender.complete()
+                self.completed += 1
+                if recommender.usage is not None:
+                    self.usage["prompt_tokens"] += recommender.usage["prompt_tokens"]
+                    self.usage["cached_tokens"] += recommender.usage["cached_tokens"]
+            except Exception as e:
+                self.failed += 1
+                logger.exception(f"Test failed: {e}")
+            finally:
+                queue.task_done()
+                logger.info(f"Progress: {self.completed + self.failed + self.skipped}/{total}")
+
+    async def run_embeddings(self, cells, total):
+        recommenders = []
+        for prompt, config, survey, repeat in cells:
+            try:
+                recommender = self.prepare(prompt, config, survey, repeat)
+                if recommender is not None:
+                    recommenders.append(recommender)
+            except Exception as e:
+                self.failed += 1
+                logger.exception(f"Test failed: {e}")
+
+        for start in range(0, len(recommenders), self.embeddings_batch):
+            batch = recommenders[start:start + self.embeddings_batch]
+            try:
+                async with self.get_semaphore('Embeddings'), self.slots:
+                    await run_embeddings_batch(batch)
+                self.completed += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                logger.exception(f"Embeddings batch failed: {e}")
+            finally:
+                logger.info(f"Progress: {self.completed + self.failed + self.skipped}/{total}")
@@ -0,0 +1,101 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import threading
+
+from dotenv import load_dotenv
+from loguru import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+load_dotenv()
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_options(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class UploadCache:
+    """
+    A local manifest mapping dataset content hashes (plus model, instructions and tools) to the
+    `file-`, `vs_` and `asst_` ids already created for them, so each artifact is built once per
+    dataset instead of once per test.
+
+    Workers in the same process serialize on a per-key asyncio lock so only one of them uploads,
+    and writes merge into the manifest under a file lock so separate processes can share it.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                                         os.getenv("UPLOAD_MANIFEST", ".cache/uploads.json")))
+        self.locks = {}
+        self.hashes = {}
+        self.thread_lock = threading.Lock()
+
+    def lock(self, kind, key):
+        name = f"{kind}:{key}"
+        if name not in self.locks:
+            self.locks[name] = asyncio.Lock()
+        return self.locks[name]
+
+    def content_hash(self, file_path):
+        stat = os.stat(file_path)
+        signature = (os.path.abspath(file_path), stat.st_mtime, stat.st_size)
+        if signature not in self.hashes:
+            self.hashes[signature] = hash_file(file_path)
+        return self.hashes[signature]
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (ValueError, OSError) as e:
+            logger.warning(f"Ignoring unreadable upload manifest {self.path}: {e}")
+            return {}
+
+    def get(self, kind, key):
+        return self.read().get(kind, {}).get(key)
+
+    def set(self, kind, key, entry):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.thread_lock, open(self.path + '.lock', 'w') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            manifest = self.read()
+            if entry is None:
+                manifest.get(kind, {}).pop(key, None)
+            else:
+                entry["updated"] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                manifest.setdefault(kind, {})[key] = entry
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+    def invalidate(self, kind, key):
+        self.set(kind, key, None)
+
+
+_upload_cache = None
+
+
+def get_upload_cache():
+    global _upload_cache
+    if _upload_cache is None:
+        _upload_cache = UploadCache()
+    return _upload_cache
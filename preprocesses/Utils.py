@@ -1,11 +1,13 @@
 import csv
 import fnmatch
+import functools
 import hashlib
 import json
 import os
 import re
 import sys
 
+import tiktoken
 from dateutil.parser import parse
 
 
@@ -50,6 +52,34 @@ def read_csv(file_path):
         print(f"Error reading {file_path}: {e}")
         sys.exit(1)
 
+def parse_options(argv, spec):
+    """
+    Split command line arguments into positional arguments and `--flag` options.
+
+    :param argv: The arguments to parse, usually `sys.argv[1:]`.
+    :param spec: A dict of option name to type. `bool` options take no value, anything else casts the next argument.
+    :return: A tuple of (positional arguments, options dict).
+    """
+    args = []
+    options = {}
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        name = arg[2:].replace('-', '_').split('=', 1)[0]
+        if not arg.startswith('--') or name not in spec:
+            args.append(arg)
+        elif spec[name] is bool:
+            options[name] = True
+        elif '=' in arg:
+            options[name] = spec[name](arg.split('=', 1)[1])
+        elif i + 1 < len(argv):
+            i += 1
+            options[name] = spec[name](argv[i])
+        else:
+            raise ValueError(f"Missing value for {arg}")
+        i += 1
+    return args, options
+
 def build_survey(csv_file_path):
     try:
         with open(csv_file_path, newline='') as csvfile:
@@ -101,8 +131,24 @@ def get_nested(data, keys, default=None):
             return default
     return data
 
+def parse_jsonl(text):
+    """
+    The records of a JSON lines dataset, as written by `normalize_dataset --jsonl`.
+    """
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def load_records(file_path):
+    """
+    The records of a .json (array) or .jsonl dataset.
+    """
+    with open(file_path, 'r') as f:
+        return parse_jsonl(f.read()) if file_path.endswith('.jsonl') else json.load(f)
+
+
 def find_json(string):
-    start_index = min(string.find('{'), string.find('['))
+    starts = [index for index in (string.find('{'), string.find('[')) if index != -1]  # -1 is "not found"
+    start_index = min(starts) if len(starts) > 0 else -1
     if start_index == -1:
         print('No JSON object found in the string.')
         return None
@@ -121,6 +167,40 @@ def find_json(string):
 
 
 
+# Context windows by model prefix; the longest matching prefix wins
+MODEL_CONTEXT_LIMITS = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-3.5-turbo-instruct': 4096,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-4-turbo': 128000,
+    'gpt-4-1106': 128000,
+    'gpt-4-0125': 128000,
+    'gpt-4o': 128000,
+}
+
+
+def context_limit(model_name):
+    matches = [prefix for prefix in MODEL_CONTEXT_LIMITS if model_name.startswith(prefix)]
+    if len(matches) == 0:
+        return int(os.getenv("DEFAULT_CONTEXT_LIMIT", 16385))
+    return MODEL_CONTEXT_LIMITS[max(matches, key=len)]
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# datasets and instructions repeat across every prompt x survey cell, so their counts are kept
+@functools.lru_cache(maxsize=4096)
+def count_tokens(model_name, text):
+    return len(get_encoding(model_name).encode(text))
+
+
 def make_test_id(input_string):
     sha256_hash = hashlib.sha256(input_string.encode())
     checksum = sha256_hash.hexdigest()
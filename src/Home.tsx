@@ -1,12 +1,38 @@
 import React from 'react';
 import DataTable from "./components/DataTable";
 import {schema} from "./schema";
-import {useSourceData} from "./SourceDataContext";
+import {ColumnSummaries, ColumnSummary, useSourceData} from "./SourceDataContext";
 
 const FIELDSCHEMA = schema();
+const HIDDEN_FIELDS = ['filename', 'runkey'];
+
+const makeLabel = (field: string) => field.split('_').map((word) => word.charAt(0).toUpperCase() + word.slice(1)).join(' ');
+
+const summaryColumn = (field: string, summary: ColumnSummary) => {
+    const numeric = typeof summary.min === 'number';
+    return {
+        field: field,
+        headerName: makeLabel(field),
+        type: numeric ? 'number' : 'string',
+        sortable: true,
+        filterable: !numeric && summary.values !== null, // short distinct values are worth searching
+        showing: numeric && HIDDEN_FIELDS.indexOf(field) === -1,
+    }
+}
+
+// the schema's columns that the indexed results actually have, then any others the manifest lists
+const resultsSchema = (summaries: ColumnSummaries | null) => {
+    if (!summaries) return FIELDSCHEMA;
+    const known = FIELDSCHEMA.filter((col: any) => summaries[col.field] && summaries[col.field].count > 0);
+    const extra = Object.keys(summaries)
+        .filter((field) => summaries[field].count > 0 && !FIELDSCHEMA.some((col: any) => col.field === field))
+        .map((field) => summaryColumn(field, summaries[field]));
+    return known.concat(extra);
+}
 
 const Home: React.FC = () => {
-    const {results, promptId} = useSourceData();
+    const {results, promptId, resultColumns} = useSourceData();
+    const columns = React.useMemo(() => resultsSchema(resultColumns), [resultColumns]);
 
     if (!results || !Array.isArray(results)) return <div>loading menu...</div>
     if (results.length === 0) return <div>no results</div>
@@ -17,7 +43,7 @@ const Home: React.FC = () => {
                 prompt_id={promptId}
                 searchTools={true}
                 title={'OpenAI Results'}
-                columns={FIELDSCHEMA}
+                columns={columns}
             />
     );
 };
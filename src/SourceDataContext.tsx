@@ -31,6 +31,18 @@ export interface ResultData {
     results: object | null;
 }
 
+// per-column summaries from the results manifest written by `index_results`
+export interface ColumnSummary {
+    count: number;
+    values: any[] | null;
+    min?: number;
+    max?: number;
+}
+
+export interface ColumnSummaries {
+    [field: string]: ColumnSummary;
+}
+
 export interface SourceData {
     source_id: number;
 }
@@ -63,6 +75,9 @@ interface SourceDataContextType {
     promptId: string;
     setPromptId: React.Dispatch<React.SetStateAction<string>>;
 
+    resultColumns: ColumnSummaries | null;
+    setResultColumns: React.Dispatch<React.SetStateAction<ColumnSummaries | null>>;
+
     surveys: SurveyList;
 
 }
@@ -89,13 +104,19 @@ export const SourceDataProvider: React.FC<SourceDataProviderProps> = ({children}
     const [results, setResults] = useState<ResultData[] | null>(null);
     const [promptId, setPromptId] = React.useState('all');
     const [surveys, setSurveys] = React.useState<SurveyList>({});
+    const [resultColumns, setResultColumns] = useState<ColumnSummaries | null>(null);
 
 
     useEffect(() => {
         const fetchDataSet = async () => {
             const response = await fetch('/' + process.env.REACT_APP_DATASET_PATH);
-            const jsonData = await response.json();
-            setSourceData(jsonData);
+            const text = await response.text();
+            try {
+                setSourceData(JSON.parse(text));
+            } catch (error) {
+                // `normalize_dataset --jsonl` writes one record per line
+                setSourceData(text.split('\n').filter((line) => line.trim().length > 0).map((line) => JSON.parse(line)));
+            }
         };
         fetchDataSet();
 
@@ -117,7 +138,8 @@ export const SourceDataProvider: React.FC<SourceDataProviderProps> = ({children}
             setMatches,
             maxStrLength,
             setMaxLength,
-            results, setResults, setPromptId, promptId, surveys
+            results, setResults, setPromptId, promptId, surveys,
+            resultColumns, setResultColumns
         }}>
             {children}
         </SourceDataContext.Provider>
@@ -86,7 +86,7 @@ const DataTable = (props) => {
 
     useEffect(() => {
         searchData()
-    }, [state.searchText, props.prompt_id, state.searchFields, state.searchCondition]);
+    }, [props.rows, state.searchText, props.prompt_id, state.searchFields, state.searchCondition]);
 
 
     const compareStr = (a) => {
@@ -117,7 +117,7 @@ const DataTable = (props) => {
                 if (props.prompt_id === '0') {
                     if (typeof row.prompt_id !== 'undefined') return false;
                 } else if (props.prompt_id !== 'all') {
-                    if (row.prompt_id !== props.prompt_id) {
+                    if (String(row.prompt_id) !== props.prompt_id) {
                         return false;
                     } else {
                         console.log('is match', row.prompt_id)
@@ -1,5 +1,5 @@
 import React, {useEffect} from 'react';
-import {AppBar, Box, Grid, MenuItem, TextField} from "@mui/material";
+import {AppBar, Box, Button, Grid, MenuItem, TextField, Typography} from "@mui/material";
 import IconButton from "@mui/material/IconButton";
 import MenuIcon from "@mui/icons-material/Menu";
 import Drawer from "@mui/material/Drawer";
@@ -7,7 +7,26 @@ import ChevronRightIcon from "@mui/icons-material/ChevronRight";
 import DrawerMenu from "../components/DrawerMenu";
 import LookupDrawer from "../components/LookupDrawer";
 import {styled} from "@mui/material/styles";
-import {useSourceData} from "../SourceDataContext";
+import {ColumnSummaries, ResultData, useSourceData} from "../SourceDataContext";
+
+// `index_results` writes the index sharded by prompt_id next to the single file, e.g. /bags-results/manifest.json
+const RESULTS_SHARDS = `/${process.env.REACT_APP_RESULTS_INDEX}`.replace(/\.json$/, '');
+// with All Prompt IDs selected, shards are loaded a page of about this many rows at a time
+const RESULTS_PAGE_ROWS = 250;
+
+interface ResultsShard {
+    prompt_id: string | number | null;
+    file: string;
+    rows: number;
+    bytes: number;
+}
+
+interface ResultsManifest {
+    version: number;
+    rows: number;
+    shards: ResultsShard[];
+    columns: ColumnSummaries;
+}
 
 const DrawerHeader = styled('div')(({theme}) => ({
     display: 'flex',
@@ -21,9 +40,12 @@ interface LayoutProps {
 }
 
 const Layout: React.FC<LayoutProps> = ({children}) => {
-    const {selectedSourceId, setResults, promptId, setPromptId} = useSourceData();
+    const {selectedSourceId, setResults, promptId, setPromptId, setResultColumns} = useSourceData();
     const [open, setOpen] = React.useState(false);
     const [allPromptIds, setAllPromptIds] = React.useState([]);
+    const [manifest, setManifest] = React.useState<ResultsManifest | null>(null);
+    const [pages, setPages] = React.useState(1);
+    const shards = React.useRef<{ [file: string]: ResultData[] }>({});
 
     useEffect(() => {
         const fetchData = async () => {
@@ -50,9 +72,76 @@ const Layout: React.FC<LayoutProps> = ({children}) => {
                 window.alert('Error loading Menu')
             }
         }
-        fetchData();
+
+        const fetchManifest = async () => {
+            try {
+                const response = await fetch(`${RESULTS_SHARDS}/manifest.json`);
+                if (!response.ok || !(response.headers.get('content-type') || '').includes('json')) {
+                    throw new Error('No results manifest');
+                }
+                const data: ResultsManifest = await response.json();
+                // @ts-ignore
+                setAllPromptIds(data.shards.filter((s) => s.prompt_id !== null).map((s) => String(s.prompt_id)))
+                setResultColumns(data.columns)
+                setManifest(data)
+            } catch (error) {
+                // indexes built before sharding only have the single file
+                fetchData();
+            }
+        }
+        fetchManifest();
     }, []);
 
+    useEffect(() => {
+        setPages(1);
+    }, [promptId]);
+
+    // a selected prompt needs only its own shard; All Prompt IDs pages through the shards in manifest order
+    const wanted = React.useMemo(() => {
+        if (!manifest) return [];
+        if (promptId === '0') return manifest.shards.filter((s) => s.prompt_id === null);
+        if (promptId !== 'all') return manifest.shards.filter((s) => String(s.prompt_id) === promptId);
+        let rows = 0;
+        return manifest.shards.filter((s) => {
+            const include = rows < pages * RESULTS_PAGE_ROWS;
+            rows += s.rows;
+            return include;
+        });
+    }, [manifest, promptId, pages]);
+
+    useEffect(() => {
+        if (!manifest) return;
+        let cancelled = false;
+
+        const fetchShards = async () => {
+            let loaded: ResultData[] = [];
+            for (const shard of wanted) {
+                if (!shards.current[shard.file]) {
+                    try {
+                        const response = await fetch(`${RESULTS_SHARDS}/${shard.file}`);
+                        if (!response.ok) {
+                            throw new Error(`Failed to fetch ${shard.file}`);
+                        }
+                        shards.current[shard.file] = await response.json();
+                    } catch (error) {
+                        console.error('Error fetching results:', error);
+                        continue;
+                    }
+                }
+                if (cancelled) return;
+                // show each shard as it arrives instead of waiting for all of them
+                loaded = loaded.concat(shards.current[shard.file]);
+                setResults(loaded)
+            }
+            if (!cancelled && wanted.length === 0) setResults([])
+        }
+        fetchShards();
+        return () => {
+            cancelled = true;
+        }
+    }, [manifest, wanted]);
+
+    const loadedRows = wanted.reduce((total, s) => total + s.rows, 0);
 
     const handleDrawerOpen = () => {
         setOpen(true);
@@ -108,6 +197,18 @@ const Layout: React.FC<LayoutProps> = ({children}) => {
                         </Grid>
                     </AppBar>
                     {children}
+                    {manifest && promptId === 'all' && wanted.length < manifest.shards.length &&
+                        <Grid container justifyContent={'center'} alignItems={'center'} padding={2} spacing={2}>
+                            <Grid item>
+                                <Typography variant={'caption'}>{loadedRows} of {manifest.rows} results loaded</Typography>
+                            </Grid>
+                            <Grid item>
+                                <Button variant={'outlined'} size={'small'} onClick={() => setPages(pages + 1)}>
+                                    Load more results
+                                </Button>
+                            </Grid>
+                        </Grid>
+                    }
                 </Grid>
             </Grid>
             <Drawer